@@ -2,6 +2,9 @@ from detectron2.config import CfgNode as CN
 
 
 def add_continual_config(cfg):
+    # Adding the node twice would reset values already merged into it
+    if hasattr(cfg, "CONT"):
+        return
     cfg.CONT = CN()
     cfg.CONT.OLD_MODEL = True
     cfg.CONT.TOT_CLS = 150
@@ -1,4 +1,3 @@
-import copy
 import itertools
 import logging
 import os
@@ -6,7 +5,7 @@ import weakref
 
 from collections import OrderedDict
 from tabulate import tabulate
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Set, Tuple
 
 import torch
 
@@ -24,17 +23,10 @@ from detectron2.engine import (
     launch,
 )
 from detectron2.evaluation import (
-    CityscapesInstanceEvaluator,
-    CityscapesSemSegEvaluator,
-    COCOEvaluator,
-    COCOPanopticEvaluator,
     DatasetEvaluator,
     DatasetEvaluators,
-    LVISEvaluator,
-    SemSegEvaluator,
     inference_on_dataset,
     print_csv_format,
-    verify_results,
 )
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
 from detectron2.solver.build import maybe_add_gradient_clipping
@@ -46,7 +38,6 @@ from fvcore.nn.precise_bn import get_bn_modules
 from mask2former import (
     COCOInstanceNewBaselineDatasetMapper,
     COCOPanopticNewBaselineDatasetMapper,
-    InstanceSegEvaluator,
     MaskFormerInstanceDatasetMapper,
     MaskFormerPanopticDatasetMapper,
     MaskFormerSemanticDatasetMapper,
@@ -61,7 +52,15 @@ from .evaluator import SemSegEvaluator, COCOPanopticEvaluator, InstanceSegEvalua
 from .train_loop import SimpleTrainer, AMPTrainer
 import torch.distributed as dist
 import collections
-import functools
+
+# Rows of the result summary logged by `Trainer.test`:
+# (task key, metric names, metric suffixes, split names of the result keys)
+_RESULT_TABLE_SPEC = (
+    ("sem_seg", ("mIoU", "mACC"), ("",), ("old", "new", "past", "current", "all")),
+    ("segm", ("AP",), ("",), ("old", "new", "past", "current", "all")),
+    ("panoptic_seg", ("PQ", "SQ", "RQ"), ("", "_th", "_st"), ("Old", "New", "Past", "Current", "All")),
+)
+
 
 class Trainer(DefaultTrainer):
 
@@ -77,6 +76,17 @@ class Trainer(DefaultTrainer):
         if not logger.isEnabledFor(logging.INFO):  # setup_logger is not called for d2
             setup_logger()
 
+        if cfg.SOLVER.TF32:
+            # TF32 matmuls/convolutions on Ampere+ GPUs
+            logger.info("SOLVER.TF32 is on: fp32 matmuls and convolutions use TF32")
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+        # cuDNN autotuning only pays off for fixed-shape batches, which the LSJ mappers produce.
+        # Otherwise keep what `default_setup` set from cfg.CUDNN_BENCHMARK.
+        if cfg.INPUT.DATASET_MAPPER_NAME.endswith("_lsj"):
+            torch.backends.cudnn.benchmark = True
+
         if cfg.CONT.TASK > 1 and cfg.CONT.OLD_MODEL:
             cfg = DefaultTrainer.auto_scale_workers(cfg, comm.get_world_size())
             cfg_old = cfg.clone()
@@ -88,10 +98,39 @@ class Trainer(DefaultTrainer):
                 cfg_old.OUTPUT_DIR = cfg.OUTPUT_DIR[:-2] + f"{cfg_old.CONT.TASK}"
             cfg_old.freeze()
 
+            # Only rank 0 reads the checkpoint, the other ranks go straight on to the DDP
+            # wrapping below. With broadcast_buffers=False its initial sync only broadcasts
+            # rank 0's parameters, so the buffers (e.g. all FrozenBN weights and statistics)
+            # are broadcast explicitly right after it.
             model_old = self.build_model(cfg_old).eval()
-            model_old.load_state_dict(
-                torch.load(cfg.CONT.OLD_WEIGHTS, map_location=torch.device("cpu"))["model"], strict=False)
+            if comm.is_main_process():
+                # Prefer a safetensors copy of the checkpoint (see
+                # tools/convert-d2-model-to-safetensors.py), otherwise mmap the checkpoint.
+                # The safetensors file only holds the model, so it is loaded straight onto the
+                # device and the parameters are rebound to the loaded tensors. The .pth file also
+                # holds the optimizer, scheduler and scaler state: it is mapped on the CPU and
+                # load_state_dict copies only the model tensors to the device.
+                safetensors_file = os.path.splitext(cfg.CONT.OLD_WEIGHTS)[0] + ".safetensors"
+                if cfg.CONT.OLD_WEIGHTS.endswith(".pth") and os.path.exists(safetensors_file):
+                    from safetensors.torch import load_file
+
+                    state_dict = load_file(safetensors_file, device=str(model_old.device))
+                    assign = True
+                else:
+                    state_dict = torch.load(
+                        cfg.CONT.OLD_WEIGHTS, map_location="cpu", mmap=True, weights_only=True
+                    )["model"]
+                    assign = False
+                incompatible = model_old.load_state_dict(state_dict, strict=False, assign=assign)
+                if incompatible.missing_keys:
+                    logger.warning(
+                        "Old model weights not found in %s, left at their initialization: %s",
+                        cfg.CONT.OLD_WEIGHTS, ", ".join(incompatible.missing_keys),
+                    )
             model_old = create_ddp_model(model_old, broadcast_buffers=False)
+            if comm.get_world_size() > 1:
+                for buffer in model_old.buffers():
+                    dist.broadcast(buffer, src=0)
         else:
             for _ in range(5):
                 print("No old model")
@@ -132,24 +171,25 @@ class Trainer(DefaultTrainer):
         if output_folder is None:
             output_folder = os.path.join(cfg.OUTPUT_DIR, "inference")
         evaluator_list = []
-        evaluator_type = MetadataCatalog.get(dataset_name).evaluator_type
+        test_cfg = cfg.MODEL.MASK_FORMER.TEST
+        semantic_on, panoptic_on, instance_on = test_cfg.SEMANTIC_ON, test_cfg.PANOPTIC_ON, test_cfg.INSTANCE_ON
         # semantic segmentation
-        if cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON:
+        if semantic_on:
             evaluator_list.append(
                 SemSegEvaluator(dataset_name, distributed=True, output_dir=output_folder, cfg=cfg)
             )
         # panoptic segmentation
-        if cfg.MODEL.MASK_FORMER.TEST.PANOPTIC_ON:
+        if panoptic_on:
             evaluator_list.append(COCOPanopticEvaluator(dataset_name, output_folder, cfg=cfg))
         # ADE20K
         # if evaluator_type == "ade20k_panoptic_seg" and cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON:
-        if cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON:
+        if instance_on:
             evaluator_list.append(InstanceSegEvaluator(dataset_name, output_dir=output_folder, cfg=cfg))
 
         if len(evaluator_list) == 0:
             raise NotImplementedError(
                 "no Evaluator for the dataset {} with the type {}".format(
-                    dataset_name, evaluator_type
+                    dataset_name, MetadataCatalog.get(dataset_name).evaluator_type
                 )
             )
         elif len(evaluator_list) == 1:
@@ -161,35 +201,36 @@ class Trainer(DefaultTrainer):
         # Semantic segmentation dataset mapper
         if cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_semantic":
             mapper = MaskFormerSemanticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # Panoptic segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_panoptic":
             mapper = MaskFormerPanopticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # Instance segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_instance":
             mapper = MaskFormerInstanceDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # coco instance segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_instance_lsj":
             mapper = COCOInstanceNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         # coco panoptic segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_panoptic_lsj":
             mapper = COCOPanopticNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         elif cfg.INPUT.DATASET_MAPPER_NAME == "continual_panoptic":
             mapper = ContinualPanopticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         elif cfg.INPUT.DATASET_MAPPER_NAME == "continual_semantic":
             mapper = ContinualSemanticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         elif cfg.INPUT.DATASET_MAPPER_NAME == "continual_instance":
             mapper = ContinualInstanceDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
         else:
             mapper = None
-            return build_detection_train_loader(cfg, mapper=mapper)
+        # Keep the workers alive across epochs and copy batches into pinned memory
+        num_workers = cfg.DATALOADER.NUM_WORKERS
+        return build_detection_train_loader(
+            cfg,
+            mapper=mapper,
+            total_batch_size=cfg.SOLVER.IMS_PER_BATCH,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=torch.cuda.is_available(),
+        )
 
     @classmethod
     def build_lr_scheduler(cls, cfg, optimizer):
@@ -201,12 +242,13 @@ class Trainer(DefaultTrainer):
 
     @classmethod
     def build_optimizer(cls, cfg, model):
+        logger = logging.getLogger("detectron2.trainer")
         weight_decay_norm = cfg.SOLVER.WEIGHT_DECAY_NORM
         weight_decay_embed = cfg.SOLVER.WEIGHT_DECAY_EMBED
 
-        defaults = {}
-        defaults["lr"] = cfg.SOLVER.BASE_LR
-        defaults["weight_decay"] = cfg.SOLVER.WEIGHT_DECAY
+        base_lr = cfg.SOLVER.BASE_LR
+        backbone_lr = cfg.SOLVER.BASE_LR * cfg.SOLVER.BACKBONE_MULTIPLIER
+        base_weight_decay = cfg.SOLVER.WEIGHT_DECAY
 
         norm_module_types = (
             torch.nn.BatchNorm1d,
@@ -222,31 +264,47 @@ class Trainer(DefaultTrainer):
             torch.nn.LocalResponseNorm,
         )
 
-        params: List[Dict[str, Any]] = []
-        memo: Set[torch.nn.parameter.Parameter] = set()
+        # Owner module of every parameter, the first one wins for shared parameters.
+        # The module type checks are done once per module here, not once per parameter.
+        module_of_param: Dict[int, Tuple[str, torch.nn.Module]] = {}
+        norm_ids: Set[int] = set()
+        embed_ids: Set[int] = set()
         for module_name, module in model.named_modules():
-            for module_param_name, value in module.named_parameters(recurse=False):
-                if not value.requires_grad:
-                    continue
-                # Avoid duplicating parameters
-                if value in memo:
-                    continue
-                memo.add(value)
-
-                hyperparams = copy.copy(defaults)
-                if "backbone" in module_name:
-                    hyperparams["lr"] = hyperparams["lr"] * cfg.SOLVER.BACKBONE_MULTIPLIER
-                if (
-                    "relative_position_bias_table" in module_param_name
-                    or "absolute_pos_embed" in module_param_name
-                ):
-                    print(module_param_name)
-                    hyperparams["weight_decay"] = 0.0
-                if isinstance(module, norm_module_types):
-                    hyperparams["weight_decay"] = weight_decay_norm
-                if isinstance(module, torch.nn.Embedding):
-                    hyperparams["weight_decay"] = weight_decay_embed
-                params.append({"params": [value], **hyperparams})
+            if isinstance(module, norm_module_types):
+                norm_ids.add(id(module))
+            if isinstance(module, torch.nn.Embedding):
+                embed_ids.add(id(module))
+            for value in module.parameters(recurse=False):
+                module_of_param.setdefault(id(value), (module_name, module))
+
+        # Parameters sharing the same (lr, weight_decay) go into a single param group,
+        # so the optimizer iterates a handful of groups instead of one per tensor.
+        grouped_params: Dict[Tuple[float, float], List[torch.nn.parameter.Parameter]] = {}
+        # named_parameters() already skips duplicated parameters
+        for param_name, value in model.named_parameters():
+            if not value.requires_grad:
+                continue
+            module_name, module = module_of_param[id(value)]
+            module_param_name = param_name.rsplit(".", 1)[-1]
+
+            lr = backbone_lr if "backbone" in module_name else base_lr
+            weight_decay = base_weight_decay
+            if (
+                "relative_position_bias_table" in module_param_name
+                or "absolute_pos_embed" in module_param_name
+            ):
+                logger.debug("Zero weight decay for %s", param_name)
+                weight_decay = 0.0
+            if id(module) in norm_ids:
+                weight_decay = weight_decay_norm
+            if id(module) in embed_ids:
+                weight_decay = weight_decay_embed
+            grouped_params.setdefault((lr, weight_decay), []).append(value)
+
+        params: List[Dict[str, Any]] = [
+            {"params": values, "lr": lr, "weight_decay": weight_decay}
+            for (lr, weight_decay), values in grouped_params.items()
+        ]
 
         def maybe_add_full_model_gradient_clipping(optim):
             # detectron2 doesn't have full model gradient clipping now
@@ -260,20 +318,29 @@ class Trainer(DefaultTrainer):
             class FullModelGradientClippingOptimizer(optim):
                 def step(self, closure=None):
                     all_params = itertools.chain(*[x["params"] for x in self.param_groups])
-                    torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val)
+                    torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val, foreach=multi_tensor)
                     super().step(closure=closure)
 
             return FullModelGradientClippingOptimizer if enable else optim
 
+        # Use the multi-tensor (foreach) kernels on CUDA. The fused AdamW kernel skips the
+        # GradScaler unscale before `step()`, so it is only used without gradient clipping,
+        # which would otherwise clip the scaled gradients.
+        multi_tensor = all(value.is_cuda for values in grouped_params.values() for value in values)
+        fused = multi_tensor and not cfg.SOLVER.CLIP_GRADIENTS.ENABLED
+
         optimizer_type = cfg.SOLVER.OPTIMIZER
         if optimizer_type == "SGD":
             optimizer = maybe_add_full_model_gradient_clipping(torch.optim.SGD)(
-                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM
+                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM, foreach=multi_tensor
             )
         elif optimizer_type == "ADAMW":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
-                params, cfg.SOLVER.BASE_LR
-            )
+            if fused:
+                optimizer = torch.optim.AdamW(params, cfg.SOLVER.BASE_LR, fused=True)
+            else:
+                optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
+                    params, cfg.SOLVER.BASE_LR, foreach=multi_tensor
+                )
         else:
             raise NotImplementedError(f"no optimizer type {optimizer_type}")
         if not cfg.SOLVER.CLIP_GRADIENTS.CLIP_TYPE == "full_model":
@@ -349,107 +416,15 @@ class Trainer(DefaultTrainer):
                 print_csv_format(results_i)
 
                 table_list = []
-                if "sem_seg" in results_i.keys():
-                    table_list.append([
-                        "mIoU",
-                        results_i["sem_seg"]["mIoU_old"],
-                        results_i["sem_seg"]["mIoU_new"],
-                        results_i["sem_seg"]["mIoU_past"],
-                        results_i["sem_seg"]["mIoU_current"],
-                        results_i["sem_seg"]["mIoU_all"]
-                    ])
-                    table_list.append([
-                        "mACC",
-                        results_i["sem_seg"]["mACC_old"],
-                        results_i["sem_seg"]["mACC_new"],
-                        results_i["sem_seg"]["mACC_past"],
-                        results_i["sem_seg"]["mACC_current"],
-                        results_i["sem_seg"]["mACC_all"]
-                    ])
-
-                if "segm" in results_i.keys():
-                    table_list.append([
-                        "AP",
-                        results_i["segm"]["AP_old"],
-                        results_i["segm"]["AP_new"],
-                        results_i["segm"]["AP_past"],
-                        results_i["segm"]["AP_current"],
-                        results_i["segm"]["AP_all"]
-                    ])
-
-                if "panoptic_seg" in results_i.keys():
-                    table_list.append([
-                        "PQ",
-                        results_i["panoptic_seg"]["PQ_Old"],
-                        results_i["panoptic_seg"]["PQ_New"],
-                        results_i["panoptic_seg"]["PQ_Past"],
-                        results_i["panoptic_seg"]["PQ_Current"],
-                        results_i["panoptic_seg"]["PQ_All"]
-                    ])
-                    table_list.append([
-                        "PQ_th",
-                        results_i["panoptic_seg"]["PQ_Old_th"],
-                        results_i["panoptic_seg"]["PQ_New_th"],
-                        results_i["panoptic_seg"]["PQ_Past_th"],
-                        results_i["panoptic_seg"]["PQ_Current_th"],
-                        results_i["panoptic_seg"]["PQ_All_th"]
-                    ])
-                    table_list.append([
-                        "PQ_st",
-                        results_i["panoptic_seg"]["PQ_Old_st"],
-                        results_i["panoptic_seg"]["PQ_New_st"],
-                        results_i["panoptic_seg"]["PQ_Past_st"],
-                        results_i["panoptic_seg"]["PQ_Current_st"],
-                        results_i["panoptic_seg"]["PQ_All_st"]
-                    ])
-                    table_list.append([
-                        "SQ",
-                        results_i["panoptic_seg"]["SQ_Old"],
-                        results_i["panoptic_seg"]["SQ_New"],
-                        results_i["panoptic_seg"]["SQ_Past"],
-                        results_i["panoptic_seg"]["SQ_Current"],
-                        results_i["panoptic_seg"]["SQ_All"]
-                    ])
-                    table_list.append([
-                        "SQ_th",
-                        results_i["panoptic_seg"]["SQ_Old_th"],
-                        results_i["panoptic_seg"]["SQ_New_th"],
-                        results_i["panoptic_seg"]["SQ_Past_th"],
-                        results_i["panoptic_seg"]["SQ_Current_th"],
-                        results_i["panoptic_seg"]["SQ_All_th"]
-                    ])
-                    table_list.append([
-                        "SQ_st",
-                        results_i["panoptic_seg"]["SQ_Old_st"],
-                        results_i["panoptic_seg"]["SQ_New_st"],
-                        results_i["panoptic_seg"]["SQ_Past_st"],
-                        results_i["panoptic_seg"]["SQ_Current_st"],
-                        results_i["panoptic_seg"]["SQ_All_st"]
-                    ])
-                    table_list.append([
-                        "RQ",
-                        results_i["panoptic_seg"]["RQ_Old"],
-                        results_i["panoptic_seg"]["RQ_New"],
-                        results_i["panoptic_seg"]["RQ_Past"],
-                        results_i["panoptic_seg"]["RQ_Current"],
-                        results_i["panoptic_seg"]["RQ_All"]
-                    ])
-                    table_list.append([
-                        "RQ_th",
-                        results_i["panoptic_seg"]["RQ_Old_th"],
-                        results_i["panoptic_seg"]["RQ_New_th"],
-                        results_i["panoptic_seg"]["RQ_Past_th"],
-                        results_i["panoptic_seg"]["RQ_Current_th"],
-                        results_i["panoptic_seg"]["RQ_All_th"]
-                    ])
-                    table_list.append([
-                        "RQ_st",
-                        results_i["panoptic_seg"]["RQ_Old_st"],
-                        results_i["panoptic_seg"]["RQ_New_st"],
-                        results_i["panoptic_seg"]["RQ_Past_st"],
-                        results_i["panoptic_seg"]["RQ_Current_st"],
-                        results_i["panoptic_seg"]["RQ_All_st"]
-                    ])
+                for task, metrics, suffixes, splits in _RESULT_TABLE_SPEC:
+                    if task not in results_i:
+                        continue
+                    task_results = results_i[task]
+                    for metric in metrics:
+                        for suffix in suffixes:
+                            table_list.append(
+                                [metric + suffix] + [task_results[f"{metric}_{split}{suffix}"] for split in splits]
+                            )
 
                 table_headers = ["", "old", "new", "past", "current", "all"]
                 table = tabulate(table_list, headers=table_headers,
@@ -465,7 +440,7 @@ class Trainer(DefaultTrainer):
         logger = logging.getLogger("detectron2.trainer")
         self.storage.iter = self.iter
         if self.cfg.CONT.COLLECT_QUERY_MODE and self.iter == self.cfg.SOLVER.MAX_ITER:
-            import json
+            import orjson
             root = self.cfg.OUTPUT_DIR
             file = os.path.join(root, "psd_distribution.json")
             if not os.path.exists(file):
@@ -475,32 +450,34 @@ class Trainer(DefaultTrainer):
             if self.cfg.CONT.CUMULATIVE_PSDNUM == True and self.cfg.CONT.TASK > 2:
                 old_root = root[:-1] + str(self.cfg.CONT.TASK-1)
                 old_file = os.path.join(old_root, "psd_distribution.json")
-                old_save = json.load(open(old_file, 'r'))
-                save += torch.tensor(old_save)
-            with open(file, 'w+') as f:
-                json.dump(save.tolist(), f)
+                with open(old_file, 'rb') as f:
+                    old_save = orjson.loads(f.read())
+                save.add_(torch.as_tensor(old_save, dtype=save.dtype, device=save.device))
+            with open(file, 'wb') as f:
+                f.write(orjson.dumps(save.cpu().numpy(), option=orjson.OPT_SERIALIZE_NUMPY))
                 logger.info("Save psd_distribution.json to {}".format(file))
                 exit()
         elif self.iter == self.cfg.SOLVER.MAX_ITER:
             collect = self.model.module.collect  # collec:dict, key: deque
-            if dist.is_initialized():
-                print("Dist initialized, gathering collect data...")
-                # Collect data from all processes
-                gathered_collect = [None for _ in range(dist.get_world_size())]
-                print("Gathered collect data, combining...")
-                dist.all_gather_object(gathered_collect, collect)
-
-            if dist.get_rank() == 0:
+            # Collect data from all processes
+            gathered_collect = self._gather_collect(collect)
+
+            if comm.is_main_process():
                 # combine collect
-                deque_factory_with_size = functools.partial(deque_factory, self.cfg.CONT.LIB_SIZE)
-                combined_collect = collections.defaultdict(deque_factory_with_size)
-                
+                keys = set(itertools.chain.from_iterable(gathered_collect))
+                combined_collect = {key: collections.deque(maxlen=self.cfg.CONT.LIB_SIZE) for key in keys}
                 for gpu_collect in gathered_collect:
                     for key, deque_value in gpu_collect.items():
                         combined_collect[key].extend(deque_value)
 
                 file = os.path.join(self.cfg.OUTPUT_DIR, "fake_query.pkl")
-                torch.save(combined_collect, file)
+                # One stacked fp16 CPU tensor per class, so the file holds one storage record per
+                # class instead of one per query. The next step memory-maps the file instead of
+                # reading it into RAM.
+                torch.save(
+                    {key: stack_queries(queries) for key, queries in combined_collect.items() if len(queries) > 0},
+                    file,
+                )
                 # with open(file, 'wb') as f:
                 #     pickle.dump(combined_collect, f)
                 logger.info(f"Save fake_query.pkl to {file}")
@@ -512,6 +489,54 @@ class Trainer(DefaultTrainer):
             for h in self._hooks:
                 h.after_train()
 
+    def _gather_collect(self, collect):
+        """
+        Gather the fake query library of every process on the main process.
+
+        Only the class ids and the feature dim are exchanged as python objects. The queries
+        themselves are packed into one zero-padded [num_keys, LIB_SIZE, dim] tensor per
+        process and sent with a single NCCL gather.
+
+        Returns:
+            list[dict]: one dict (class id -> tensor of queries) per process on the main
+                process, None on the others.
+        """
+        world_size = comm.get_world_size()
+        if world_size == 1:
+            return [collect]
+
+        dim = next((len(q[0]) for q in collect.values() if len(q) > 0), 0)
+        all_meta = comm.all_gather((sorted(collect.keys()), dim))
+        keys = sorted(set(itertools.chain.from_iterable(k for k, _ in all_meta)))
+        dim = max(d for _, d in all_meta)
+
+        device = torch.device("cuda", torch.cuda.current_device())
+        feats = torch.zeros((len(keys), self.cfg.CONT.LIB_SIZE, dim), dtype=torch.float16, device=device)
+        lengths = torch.zeros(len(keys), dtype=torch.long, device=device)
+        for i, key in enumerate(keys):
+            queries = collect.get(key, ())
+            if len(queries) > 0:
+                feats[i, :len(queries)] = stack_queries(queries).to(device)
+                lengths[i] = len(queries)
+
+        if comm.is_main_process():
+            feats_list = [torch.empty_like(feats) for _ in range(world_size)]
+            lengths_list = [torch.empty_like(lengths) for _ in range(world_size)]
+        else:
+            feats_list = lengths_list = None
+        dist.gather(feats, feats_list, dst=0)
+        dist.gather(lengths, lengths_list, dst=0)
+        if not comm.is_main_process():
+            return None
+
+        gathered_collect = []
+        for rank_feats, rank_lengths in zip(feats_list, lengths_list):
+            rank_feats = rank_feats.cpu()
+            gathered_collect.append(
+                {key: rank_feats[i, :n].clone() for i, (key, n) in enumerate(zip(keys, rank_lengths.tolist())) if n > 0}
+            )
+        return gathered_collect
+
     def build_hooks(self):
         """
         Build a list of default hooks, including timing, evaluation,
@@ -527,7 +552,9 @@ class Trainer(DefaultTrainer):
         ret = [
             hooks.IterationTimer(),
             hooks.LRScheduler(),
-            (
+        ]
+        if cfg.TEST.PRECISE_BN.ENABLED and get_bn_modules(self.model):
+            ret.append(
                 hooks.PreciseBN(
                     # Run at the same freq as (but before) evaluation.
                     cfg.TEST.EVAL_PERIOD,
@@ -536,10 +563,7 @@ class Trainer(DefaultTrainer):
                     self.build_train_loader(cfg),
                     cfg.TEST.PRECISE_BN.NUM_ITER,
                 )
-                if cfg.TEST.PRECISE_BN.ENABLED and get_bn_modules(self.model)
-                else None
-            ),
-        ]
+            )
 
         # Do PreciseBN before checkpointer, because it updates the model and need to
         # be saved by checkpointer.
@@ -562,5 +586,9 @@ class Trainer(DefaultTrainer):
             ret.append(hooks.PeriodicWriter(self.build_writers(), period=20))
         return ret
 
-def deque_factory(maxlen=80):
-    return collections.deque(maxlen=maxlen)
\ No newline at end of file
+def stack_queries(queries):
+    """
+    Stack a sequence of fake queries (lists of floats or 1-d tensors) into a
+    [len(queries), dim] fp16 CPU tensor, the precision the model keeps them in.
+    """
+    return torch.stack([torch.as_tensor(q, dtype=torch.float16, device="cpu") for q in queries])
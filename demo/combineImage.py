@@ -18,7 +18,7 @@ if not os.path.exists(save_dir):
 for img_name in os.listdir(folder_A):
     img_A_path = os.path.join(folder_A, img_name)
     img_B_path = os.path.join(folder_B, img_name)
-    img_GT_path = os.path.join(folder_GT, img_name.split('.')[0] + '.jpg')
+    img_GT_path = os.path.join(folder_GT, os.path.splitext(img_name)[0] + '.jpg')
 
     # Check if corresponding images exist in B and GT
     if os.path.exists(img_B_path) and os.path.exists(img_GT_path):
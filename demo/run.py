@@ -242,16 +242,10 @@ for i in ids[::-1]:
     for j, img in enumerate(image_list[i]):
         if j >10:
             break
-        gt_img_name = img.split('.')[0] + '_gt' + '.jpg'
-        img = img.split('.')[0] + '.jpg'
+        gt_img_name = os.path.splitext(img)[0] + '_gt' + '.jpg'
+        img = os.path.splitext(img)[0] + '.jpg'
         gt = os.path.join(gt_vis, img)
 
-        with open('twostageinfo/filename.txt', 'w')as f:
-            f.write(img)
-        with open('twostageinfo/filename.txt', 'r')as f:
-            a = f.readline()
-            print(a)
-
         if os.path.exists(gt):
             subprocess.run(f'bash run_demo.sh {img} {name}', shell=True)
             # subprocess.run(f'cp {gt} {output}/{name}/{gt_img_name} ', shell=True)
@@ -0,0 +1,57 @@
+"""
+In-process version of run_demo.sh: build the demo model once and run it on
+any number of images, instead of starting a new shell, python interpreter
+and CUDA context for every image.
+
+Takes the arguments of demo.py plus --input-dir, e.g.
+
+    python run_demo.py --input-dir ../datasets/100SamImg/ --output ./sam1b/ \
+        --config-file configs/ade20k/panoptic-segmentation/maskformer2_R50_bs16_160k.yaml \
+        --input a.jpg b.jpg --opts MODEL.WEIGHTS model_final.pth
+"""
+import os
+
+import torch
+from detectron2.data.detection_utils import read_image
+
+from demo import get_parser, setup_cfg
+from predictor import VisualizationDemo
+
+
+def get_run_parser():
+    parser = get_parser()
+    parser.add_argument(
+        "--input-dir",
+        default="../datasets/100SamImg/",
+        help="Directory the image names given to --input are relative to.",
+    )
+    parser.set_defaults(output="./sam1b/")
+    return parser
+
+
+def build_model(args):
+    cfg = setup_cfg(args)
+    torch.backends.cudnn.benchmark = True
+    os.makedirs(args.output, exist_ok=True)
+    return VisualizationDemo(cfg)
+
+
+def load(img_name, input_dir):
+    # use PIL, to be consistent with evaluation
+    return read_image(os.path.join(input_dir, img_name), format="BGR")
+
+
+def run(img_name, demo, output_dir, img):
+    with torch.inference_mode():
+        predictions, visualized_output = demo.run_on_image(img)
+    visualized_output.save(os.path.join(output_dir, img_name))
+    return predictions
+
+
+if __name__ == "__main__":
+    args = get_run_parser().parse_args()
+    assert args.input, "Please give the image names with --input"
+    demo = build_model(args)
+    for img_name in args.input:
+        print(img_name)
+        run(img_name, demo, args.output, load(img_name, args.input_dir))
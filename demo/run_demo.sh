@@ -14,10 +14,21 @@ base_path="../datasets/100SamImg/"
 # 定义输出路径
 # output_path="/inspurfs/group/yangsb/zhuyuchen/2stage_analyse/v2better/mask2former_2s_v2/${catname}/${filename%.*}"
 # output_path="./analysis_step3/${catname}/${filename%.*}"
-output_path="./sam1b/${filename%.*}"
+if [ -n "${filename}" ]; then
+    inputs=("${base_path}${filename}")
+    output_path="./sam1b/${filename%.*}"
+else
+    # 没有参数时从标准输入读取文件名(每行一个), 只启动一次 demo.py, 模型只加载一次
+    inputs=()
+    while IFS= read -r line; do
+        [ -n "${line}" ] && inputs+=("${base_path}${line}")
+    done
+    output_path="./sam1b/"
+    mkdir -p "${output_path}"
+fi
 # 执行命令
 python demo.py --config-file /public/home/zhuyuchen530/projects/cvpr24/fake3/configs/ade20k/panoptic-segmentation/maskformer2_R50_bs16_160k.yaml \
- --input "${base_path}${filename}" --output "${output_path}" \
+ --input "${inputs[@]}" --output "${output_path}" \
  --opts MODEL.WEIGHTS "/public/home/zhuyuchen530/projects/cvpr24/fake3/output/ps/100-5_only2stage/step1/model_final.pth"
 
 echo "命令执行完成"
\ No newline at end of file
@@ -237,15 +237,9 @@ image_list = dict(sorted(image_list.items()))
 print(image_list)
 for j, category in enumerate(image_list):
     for img in image_list[category]:
-        img = img.split('.')[0] + '.jpg'
+        img = os.path.splitext(img)[0] + '.jpg'
         gt = os.path.join(gt_vis, img)
 
-        with open('twostageinfo/filename.txt', 'w')as f:
-            f.write(img)
-        with open('twostageinfo/filename.txt', 'r')as f:
-            a = f.readline()
-            print(a)
-
         subprocess.run(f'bash run_demo.sh {img}', shell=True)
         break
         # if os.path.exists(gt):
@@ -25,6 +25,9 @@ def add_maskformer2_config(cfg):
     # optimizer
     cfg.SOLVER.OPTIMIZER = "ADAMW"
     cfg.SOLVER.BACKBONE_MULTIPLIER = 0.1
+    # TF32 fp32 matmuls and convolutions on Ampere+ GPUs. Faster, but changes fp32 numerics,
+    # so off by default (PyTorch's own defaults are kept)
+    cfg.SOLVER.TF32 = False
 
     # mask_former model config
     cfg.MODEL.MASK_FORMER = CN()
@@ -64,6 +67,11 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.MASK_FORMER.TEST.OBJECT_MASK_THRESHOLD = 0.0
     cfg.MODEL.MASK_FORMER.TEST.OVERLAP_THRESHOLD = 0.0
     cfg.MODEL.MASK_FORMER.TEST.SEM_SEG_POSTPROCESSING_BEFORE_INFERENCE = False
+    # compile the score-weighted mask argmax shared by inference and pseudo labelling
+    # with torch.compile
+    cfg.MODEL.MASK_FORMER.COMPILE_MASK_ARGMAX = False
+    # compile the transformer decoder layer loop, input preparation and prediction heads with torch.compile
+    cfg.MODEL.MASK_FORMER.COMPILE_DECODER = False
 
     # Sometimes `backbone.size_divisibility` is set to 0 for some backbone (e.g. ResNet)
     # you can use this config to override
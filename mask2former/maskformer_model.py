@@ -1,4 +1,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+import functools
 from typing import Tuple
 
 import torch
@@ -11,6 +12,7 @@ from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, build_sem_se
 from detectron2.modeling.backbone import Backbone
 from detectron2.modeling.postprocessing import sem_seg_postprocess
 from detectron2.structures import Boxes, ImageList, Instances, BitMasks
+from detectron2.utils import comm
 from detectron2.utils.memory import retry_if_cuda_oom
 from detectron2.structures import BitMasks
 
@@ -22,8 +24,36 @@ import numpy as np
 from torch.utils.tensorboard import SummaryWriter
 from collections import deque
 import pickle
-import torch.distributed as dist
-import copy
+
+def weighted_mask_argmax(scores, masks, chunk_size=32):
+    """
+    Index of the query with the highest `scores[q] * masks[q]` at every pixel.
+
+    The weighted masks are reduced `chunk_size` queries at a time against a running
+    (best value, best index) pair, so at most a chunk_size x H x W product is ever
+    materialized. Ties resolve to the lowest index, like `argmax`.
+
+    Args:
+        scores: tensor of shape (Q,)
+        masks: tensor of shape (Q, H, W)
+    Returns:
+        long tensor of shape (H, W)
+    """
+    if masks.shape[0] <= chunk_size:
+        return (scores.view(-1, 1, 1) * masks).argmax(0)
+
+    best_val, best_idx = None, None
+    for start in range(0, masks.shape[0], chunk_size):
+        end = start + chunk_size
+        val, idx = (scores[start:end].view(-1, 1, 1) * masks[start:end]).max(0)
+        if best_val is None:
+            best_val, best_idx = val, idx
+        else:
+            better = val > best_val
+            best_val = torch.where(better, val, best_val)
+            best_idx = torch.where(better, idx + start, best_idx)
+    return best_idx
+
 
 @META_ARCH_REGISTRY.register()
 class MaskFormer(nn.Module):
@@ -60,6 +90,7 @@ class MaskFormer(nn.Module):
         lib_size: int = 80,
         combine_psdlabel: bool = False,
         vq_number: int = 0,
+        compile_mask_argmax: bool = False,
     ):
         """
         Args:
@@ -84,6 +115,7 @@ class MaskFormer(nn.Module):
             instance_on: bool, whether to output instance segmentation prediction
             panoptic_on: bool, whether to output panoptic segmentation prediction
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            compile_mask_argmax: bool, whether to fuse `weighted_mask_argmax` with torch.compile
         """
         super().__init__()
         self.backbone = backbone
@@ -111,7 +143,8 @@ class MaskFormer(nn.Module):
             assert self.sem_seg_postprocess_before_inference
 
         if current_catagory_ids is not None:
-            self.current_catagory_ids = torch.tensor(current_catagory_ids)
+            # kept on the model device so generate_psd_targets can test labels without a host sync
+            self.register_buffer("current_catagory_ids", torch.tensor(current_catagory_ids), False)
         
         self.output_dir = output_dir
         
@@ -134,17 +167,33 @@ class MaskFormer(nn.Module):
             query_root = self.output_dir[:-2] + f"{task-1}"
 
 
+        self.lib_size = lib_size
+        # every process keeps its share of the library, the trainer gathers them after training
+        self.fake_query_maxlen = self.lib_size // comm.get_world_size()
         with torch.no_grad():
             self.collect = {}
             try:
                 if self.task > 1 and not self.collect_query_mode:
-                    self.collect = torch.load(f"{query_root}/fake_query.pkl", map_location='cpu')
+                    collect = torch.load(f"{query_root}/fake_query.pkl", map_location='cpu', mmap=True)
+                    # fake_query.pkl stores one stacked [n, dim] tensor per class, turn it back
+                    # into a deque of queries so new queries can still be appended. The rows are
+                    # views of the memory-mapped file, so old queries are only paged in when sampled.
+                    self.collect = {
+                        k: v if isinstance(v, deque) else deque(v.unbind(0), maxlen=self.lib_size)
+                        for k, v in collect.items()
+                    }
             except:
                 for i in range(10):
                     print(f"************No query found in {query_root}***********************")
-        self.lib_size = lib_size
         self.combine_psdlabel = combine_psdlabel
         self.vq_number = vq_number
+
+        # the Q x H x W score * mask product is only ever reduced by an argmax, compiled the
+        # two fuse into one pass and the product is never materialized
+        self.weighted_mask_argmax = weighted_mask_argmax
+        if compile_mask_argmax and hasattr(torch, "compile"):
+            self.weighted_mask_argmax = torch.compile(weighted_mask_argmax, dynamic=True)
+
     @classmethod
     def from_config(cls, cfg):
         backbone = build_backbone(cfg)
@@ -238,12 +287,30 @@ class MaskFormer(nn.Module):
             "lib_size" : cfg.CONT.LIB_SIZE,
             "combine_psdlabel": cfg.CONT.COMBINE_PSDLABEL,
             "vq_number": cfg.CONT.VQ_NUMBER,
+            "compile_mask_argmax": cfg.MODEL.MASK_FORMER.COMPILE_MASK_ARGMAX,
         }
 
     @property
     def device(self):
         return self.pixel_mean.device
 
+    @functools.cached_property
+    def n_cls_total(self):
+        # number of classes seen up to the current step, fixed once the predictor is built
+        return int(sum(self.sem_seg_head.predictor.n_cls_in_tasks))
+
+    @functools.cached_property
+    def thing_ids(self):
+        # contiguous ids of the "thing" classes, for membership tests on host ints
+        return frozenset(self.metadata.thing_dataset_id_to_contiguous_id.values())
+
+    @functools.cached_property
+    def thing_class_mask(self):
+        # bool lookup table over the contiguous class ids, True for "thing" classes
+        thing_mask = torch.zeros(self.sem_seg_head.num_classes, dtype=torch.bool, device=self.device)
+        thing_mask[list(self.thing_ids)] = True
+        return thing_mask
+
     def forward(self, batched_inputs, old_pred=None, psd_label=False, topk_feats_info=None, old_outputs=None):
         """
         Args:
@@ -272,9 +339,7 @@ class MaskFormer(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
-        images = [x["image"].to(self.device) for x in batched_inputs]
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
+        images = self.preprocess_image(batched_inputs)
 
         features = self.backbone(images.tensor)
 
@@ -298,13 +363,14 @@ class MaskFormer(nn.Module):
 
             if old_pred is not None:
                 psd_targets, old_targets = self.generate_psd_targets(targets, old_pred, gt_instances, False)
-                precise_targets, _ = self.generate_psd_targets(targets, old_pred, gt_instances, False)
+                # same arguments as above, the criterion never writes to psd_targets so share them
+                precise_targets = psd_targets
 
                 # Save the distribution of pseudo labels
                 if self.collect_query_mode:
-                    for t in psd_targets:
-                        for i in t['labels']:
-                            self.psd_num[i] += 1
+                    # one host copy and bincount per batch instead of an indexed add per pseudo label
+                    psd_labels = torch.cat([t['labels'] for t in psd_targets]).cpu()
+                    self.psd_num += torch.bincount(psd_labels, minlength=self.psd_num.numel())
                     self.count += 1
 
                 losses = self.criterion(outputs, targets, psd_targets, old_targets, topk_feats_info, old_outputs, _fake_query_labels)
@@ -327,19 +393,17 @@ class MaskFormer(nn.Module):
                 else:
                     complete_psd_targets = targets
                 indices = self.criterion.matcher(outputs_without_aux, complete_psd_targets)
-                for index, (indice, target) in enumerate(zip(indices, complete_psd_targets)):
-                    labels = target['labels']
-                    for q, l in zip(*indice):
-                        gt_class = labels[l].item()
-                        if gt_class not in self.collect:
-                            if dist.is_initialized():
-                                world_size = dist.get_world_size()
-                            else:
-                                world_size = 1 
-                            maxlen = self.lib_size //world_size
-                            self.collect[gt_class] = deque(maxlen=maxlen)
-                        
-                        self.collect[gt_class].append(outputs['topk_feats_info']['med_feats'][index][q].tolist())
+                # gather the matched queries of the whole batch and bring them to the host in one copy,
+                # instead of a .item() and a .tolist() sync per matched query
+                med_feats = outputs['topk_feats_info']['med_feats']
+                matched_feats = torch.cat([med_feats[index][q] for index, (q, _) in enumerate(indices)])
+                matched_labels = torch.cat([target['labels'][l] for (_, l), target in zip(indices, complete_psd_targets)])
+                matched_feats = matched_feats.detach().to("cpu", torch.float16)
+                for gt_class, feat in zip(matched_labels.tolist(), matched_feats):
+                    if gt_class not in self.collect:
+                        self.collect[gt_class] = deque(maxlen=self.fake_query_maxlen)
+                    
+                    self.collect[gt_class].append(feat)
             # ****************END store fake query****************
 
             for k in list(losses.keys()):
@@ -354,6 +418,12 @@ class MaskFormer(nn.Module):
             
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
+            if mask_pred_results.is_cuda and not psd_label:
+                # the full resolution masks are only sigmoid-ed and thresholded / argmax-ed below,
+                # upsample them in fp16 to halve the traffic of the largest tensors in inference.
+                # Not for psd_label: there the old model runs in eval mode while the new one trains,
+                # and its masks become pseudo-targets, so they keep their full precision
+                mask_pred_results = mask_pred_results.half()
             bbox_pred_results = outputs["pred_boxes"]
             topk_feats_info = outputs["topk_feats_info"]
             old_outputs = outputs
@@ -374,22 +444,24 @@ class MaskFormer(nn.Module):
                 if psd_label:
                     output_psd_label = {}
 
-                    scores, labels = mask_cls_result.sigmoid().max(-1)
+                    mask_cls_prob = mask_cls_result.sigmoid()
+                    scores, labels = mask_cls_prob.max(-1)
                     # n_cls = sum([cls_embed.out_features for cls_embed in self.sem_seg_head.predictor.class_embeds])
-                    n_cls = sum([cls for cls in self.sem_seg_head.predictor.n_cls_in_tasks])
-                    keep = labels.ne(n_cls) & (scores > self.psd_label_threshold)
+                    keep = labels.ne(self.n_cls_total) & (scores > self.psd_label_threshold)
                     # keep = labels.ne(n_cls) & (scores > 0.0)
 
                     # use in PS
                     if not self.combine_psdlabel:
                         T = 0.06 
-                        scores, labels = F.softmax(mask_cls_result.sigmoid() / T, dim=-1).max(-1)
-                    sort = scores[keep].argsort(descending=True)
-
-                    output_psd_label['labels'] = labels[keep][sort]
-                    output_psd_label['masks'] = mask_pred_result[keep][sort].sigmoid()
-                    output_psd_label['scores'] = scores[keep][sort]
-                    output_psd_label['boxes'] = bbox_pred_result[keep][sort]
+                        scores, labels = F.softmax(mask_cls_prob / T, dim=-1).max(-1)
+                    # sort only the kept queries, and gather every field with one index instead of two
+                    kept_scores, order = scores[keep].sort(descending=True)
+                    sort = keep.nonzero(as_tuple=True)[0][order]
+
+                    output_psd_label['labels'] = labels[sort]
+                    output_psd_label['masks'] = mask_pred_result[sort].sigmoid()
+                    output_psd_label['scores'] = kept_scores
+                    output_psd_label['boxes'] = bbox_pred_result[sort]
                     # output_psd_label['med_feats'] = {}
 
 
@@ -403,23 +475,29 @@ class MaskFormer(nn.Module):
                         mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
                             mask_pred_result, image_size, height, width
                         )
-                        mask_cls_result = mask_cls_result.to(mask_pred_result)
+                        # keep the class logits in fp32, the T=0.06 softmax is sensitive to precision
+                        mask_cls_result = mask_cls_result.to(mask_pred_result.device)
+
+                    # with more than one output on, compute the class and mask sigmoids once for all of them
+                    probs = {}
+                    if self.semantic_on + self.panoptic_on + self.instance_on > 1:
+                        probs = {"mask_cls_prob": mask_cls_result.sigmoid(), "mask_pred_prob": mask_pred_result.sigmoid()}
 
                     # semantic segmentation inference
                     if self.semantic_on:
-                        r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
+                        r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result, **probs)
                         if not self.sem_seg_postprocess_before_inference:
                             r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
                         processed_results[-1]["sem_seg"] = r
 
                     # panoptic segmentation inference
                     if self.panoptic_on:
-                        panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
+                        panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result, **probs)
                         processed_results[-1]["panoptic_seg"] = panoptic_r
                     
                     # instance segmentation inference
                     if self.instance_on:
-                        instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result)
+                        instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result, **probs)
                         processed_results[-1]["instances"] = instance_r
 
             if psd_label:
@@ -427,17 +505,48 @@ class MaskFormer(nn.Module):
             else:
                 return processed_results
 
+    def preprocess_image(self, batched_inputs):
+        """
+        Normalize, pad and batch the input images.
+
+        Same result as normalizing every image and calling `ImageList.from_tensors`, but the raw
+        images are copied straight into one padded device tensor that is normalized in place. The
+        padding is filled with `pixel_mean` first, so it still ends up as exact zeros.
+        """
+        raw_images = [x["image"] for x in batched_inputs]
+        image_sizes = [(im.shape[-2], im.shape[-1]) for im in raw_images]
+        max_h = max(h for h, _ in image_sizes)
+        max_w = max(w for _, w in image_sizes)
+        if self.size_divisibility > 1:
+            stride = self.size_divisibility
+            max_h = (max_h + stride - 1) // stride * stride
+            max_w = (max_w + stride - 1) // stride * stride
+
+        batched = self.pixel_mean.expand(len(raw_images), -1, max_h, max_w).clone()
+        for batched_im, im, (h, w) in zip(batched, raw_images, image_sizes):
+            # single H2D copy + dtype cast, asynchronous when the loader pins memory
+            batched_im[:, :h, :w].copy_(im, non_blocking=True)
+        batched.sub_(self.pixel_mean).div_(self.pixel_std)
+        return ImageList(batched, image_sizes)
+
     def prepare_targets(self, targets, images):
         h_pad, w_pad = images.tensor.shape[-2:]
         new_targets = []
-        for targets_per_image in targets:
+        # one padded buffer for the whole batch, every image gets a contiguous slice of it
+        num_masks = [t.gt_masks.shape[0] for t in targets]
+        all_padded_masks = torch.zeros(
+            (sum(num_masks), h_pad, w_pad), dtype=targets[0].gt_masks.dtype, device=targets[0].gt_masks.device
+        )
+        offset = 0
+        for targets_per_image, n in zip(targets, num_masks):
             # pad gt
             h, w = targets_per_image.image_size
             image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
 
             gt_masks = targets_per_image.gt_masks
-            padded_masks = torch.zeros((gt_masks.shape[0], h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
+            padded_masks = all_padded_masks[offset : offset + n]
             padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = gt_masks
+            offset += n
             new_targets.append(
                 {
                     "labels": targets_per_image.gt_classes,
@@ -452,9 +561,10 @@ class MaskFormer(nn.Module):
             # memory_part = [bool(
             #     torch.logical_not(torch.isin(tgt['labels'], self.current_catagory_ids.to(tgt['labels'].device))).sum() != 0
             # ) for tgt in gt_targets]
-            memory_part = [bool(
-                np.logical_not(np.isin(tgt['labels'].cpu().numpy(), self.current_catagory_ids.cpu().numpy())).sum() != 0
-            ) for tgt in gt_targets]
+            # 0-dim bool tensors, only synced if a caller actually branches on them
+            memory_part = [
+                torch.logical_not(torch.isin(tgt['labels'], self.current_catagory_ids)).any() for tgt in gt_targets
+            ]
         else:
             memory_part = None
 
@@ -495,22 +605,20 @@ class MaskFormer(nn.Module):
                 old_targets.append(old_target)
                 continue
 
-            old_area = (old_masks >= 0.5).sum(dim=(1, 2))
-            prob_masks = old_scores.view(-1, 1, 1) * old_masks
-            mask_ids = prob_masks.argmax(0)
+            fg_masks = old_masks >= 0.5
+            old_area = fg_masks.sum(dim=(1, 2))
+            mask_ids = self.weighted_mask_argmax(old_scores, old_masks)
 
-            non_ol_masks = torch.zeros_like(old_masks).to(torch.bool)
-            selected_masks = torch.zeros_like(old_masks).to(torch.bool)
-            for k in range(old_labels.shape[0]):
-                non_ol_masks[k] = (mask_ids == k) & (old_masks[k] >= 0.5)
-                selected_masks[k] = (mask_ids == k)
+            # pixels each query wins in the argmax and also covers itself, all queries at once
+            query_ids = torch.arange(old_labels.shape[0], device=mask_ids.device)
+            non_ol_masks = (mask_ids[None] == query_ids[:, None, None]) & fg_masks
 
             # if not memory_part[i]:
-            gt_region = torch.clamp(gt_target["masks"].sum(0).int(), min=0, max=1)
-            non_ol_masks = torch.logical_and(non_ol_masks, torch.logical_not(gt_region))
+            gt_region = gt_target["masks"].any(0)
+            non_ol_masks &= ~gt_region
 
             new_area = non_ol_masks.sum(dim=(1, 2))
-            argmax_area = selected_masks.sum(dim=(1, 2))
+            argmax_area = torch.bincount(mask_ids.flatten(), minlength=old_labels.shape[0])
             # keep = (new_area > 0) & (new_area > old_area * self.overlap_threshold)
             if strict_mode: # False
                 keep = (new_area > 0) & (new_area > old_area * self.psd_overlap_threshold) & (old_area > argmax_area * self.psd_overlap_threshold)
@@ -523,19 +631,18 @@ class MaskFormer(nn.Module):
             # mask = BitMasks(
             #     torch.stack([x.clone().contiguous() for x in select_masks ])
             # )
-            mask = BitMasks(select_masks.clone().contiguous())
 
             if self.combine_psdlabel:
-                unique_labels = psd_target["labels"].unique()
+                unique_labels, label_inds = psd_target["labels"].unique(return_inverse=True)
                 fused_psd_target = {"labels": [], "masks": [], "boxes": []}
                 fused_psd_target['labels'] = unique_labels
-                temp_masks = []
-                for label in unique_labels:
-                    label_mask = select_masks[psd_target["labels"] == label].sum(dim=0).clamp(min=0, max=1)
-                    temp_masks.append(label_mask)
-                if len(temp_masks) > 0:
-                    temp_masks = torch.stack(temp_masks, dim=0)
-                    temp_masks = BitMasks(temp_masks.clone().contiguous())
+                if unique_labels.numel() > 0:
+                    # union of the masks of every label, accumulated for all labels with one index_add_
+                    temp_masks = torch.zeros(
+                        (unique_labels.numel(),) + select_masks.shape[1:], dtype=torch.int32, device=select_masks.device
+                    )
+                    temp_masks.index_add_(0, label_inds, select_masks.int())
+                    temp_masks = BitMasks(temp_masks > 0)
                     fused_psd_target['masks'] = temp_masks.tensor.to(old_labels.device)
                     fused_psd_target['boxes'] = box_ops.box_xyxy_to_cxcywh(temp_masks.get_bounding_boxes().tensor).to(old_labels.device)/image_size_xyxy
                 else:
@@ -543,19 +650,24 @@ class MaskFormer(nn.Module):
                     fused_psd_target['masks'] = temp_masks
                     fused_psd_target['boxes'] = temp_masks # all tensor([])
                 psd_targets.append(fused_psd_target)
-                old_targets.append(copy.deepcopy(fused_psd_target))
+                # the criterion only reads old_targets, share the tensors instead of deep-copying them
+                old_targets.append(dict(fused_psd_target))
                 # for dd, mask in enumerate(fused_psd_target['masks']):
                 #     import cv2
                 #     cv2.imwrite(f"./temp/{i}_{k}_{fused_psd_target['labels'][dd]}.png", mask.cpu().numpy()*255)
                     
             else:
-                psd_target["masks"] = mask.tensor.to(old_labels.device)
+                # boolean indexing already returned a fresh contiguous mask tensor on the right device;
+                # get_bounding_boxes() always builds its boxes on the CPU, so those are moved
+                mask = BitMasks(select_masks)
+                psd_target["masks"] = mask.tensor
                 psd_target["boxes"] = box_ops.box_xyxy_to_cxcywh(mask.get_bounding_boxes().tensor).to(old_labels.device)/image_size_xyxy
                 psd_targets.append(psd_target)
 
-                old_target["labels"] = old_labels[keep]
-                old_target["masks"] = mask.tensor.to(old_labels.device)
-                old_target["boxes"] = box_ops.box_xyxy_to_cxcywh(mask.get_bounding_boxes().tensor).to(old_labels.device)/image_size_xyxy
+                # the criterion only reads both targets, share the tensors instead of recomputing them
+                old_target["labels"] = psd_target["labels"]
+                old_target["masks"] = psd_target["masks"]
+                old_target["boxes"] = psd_target["boxes"]
                 # old_target["scores"] = old_scores[keep]
                 # old_target["masks"] = old_masks[keep]
                 # old_target["boxes"] = old_boxes[keep]
@@ -563,11 +675,11 @@ class MaskFormer(nn.Module):
 
         return psd_targets, old_targets
 
-    def semantic_inference(self, mask_cls, mask_pred):
-        mask_cls = mask_cls.sigmoid()
+    def semantic_inference(self, mask_cls, mask_pred, mask_cls_prob=None, mask_pred_prob=None):
+        mask_cls = mask_cls.sigmoid() if mask_cls_prob is None else mask_cls_prob
         scores, labels = mask_cls.max(-1)
-        keep = labels.ne(sum([cls for cls in self.sem_seg_head.predictor.n_cls_in_tasks])) & (scores >= 0.4)
-        mask_pred = mask_pred.sigmoid()
+        keep = labels.ne(self.n_cls_total) & (scores >= 0.4)
+        mask_pred = mask_pred.sigmoid() if mask_pred_prob is None else mask_pred_prob
 
         # OPEN FOR PANOPTIC SEGMENTATION!!!
         T = 0.06
@@ -578,8 +690,6 @@ class MaskFormer(nn.Module):
         cur_classes = labels[keep]
         cur_masks = mask_pred[keep]  # sigmoid done up.
 
-        cur_prob_masks = cur_scores.view(-1, 1, 1) * cur_masks
-
         semseg = torch.ones((h, w), dtype=torch.long, device=cur_masks.device)*self.sem_seg_head.num_classes
 
         if cur_masks.shape[0] == 0:
@@ -589,26 +699,25 @@ class MaskFormer(nn.Module):
         else:
             # learn from https://github.com/clovaai/ECLIPSE/blob/main/mask2former/maskformer_model.py#L389 
 
-            cur_mask_ids = cur_prob_masks.argmax(0)
+            cur_mask_ids = self.weighted_mask_argmax(cur_scores, cur_masks)
             r = 0.5
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                mask_area = (cur_mask_ids == k).sum().item()
-                # mask_area = ((cur_mask_ids == k)& (cur_masks[k] >= r)).sum().item()
-                original_area = (cur_masks[k] >= r).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= r)
-                #fixme mask_area should be computed differently !
-                # mask_area = mask.sum().item()
-
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    # print(mask_area, original_area, mask.sum().item())
-                    if mask_area / original_area < self.overlap_threshold or original_area / mask_area < self.overlap_threshold: 
-                        continue
-                    semseg[mask] = pred_class 
+            num_masks = cur_classes.shape[0]
+            # pixels whose argmax query also covers them, i.e. the union of the per-query `mask`s
+            owned = cur_masks.gather(0, cur_mask_ids[None])[0] >= r
+            mask_area = torch.bincount(cur_mask_ids.flatten(), minlength=num_masks).double()
+            #fixme mask_area should be computed differently !
+            # mask_area = torch.bincount(cur_mask_ids[owned], minlength=num_masks).double()
+            original_area = (cur_masks >= r).sum(dim=(1, 2)).double()
+            owned_area = torch.bincount(cur_mask_ids[owned], minlength=num_masks)
+
+            valid = (mask_area > 0) & (original_area > 0) & (owned_area > 0)
+            valid &= (mask_area / original_area.clamp(min=1) >= self.overlap_threshold)
+            valid &= (original_area / mask_area.clamp(min=1) >= self.overlap_threshold)
+            semseg = torch.where(valid[cur_mask_ids] & owned, cur_classes[cur_mask_ids], semseg)
             semseg = F.one_hot(semseg, self.sem_seg_head.num_classes+1).float().permute(2, 0, 1)
         return semseg
 
-    def panoptic_inference(self, mask_cls, mask_pred):
+    def panoptic_inference(self, mask_cls, mask_pred, mask_cls_prob=None, mask_pred_prob=None):
         # scores, labels = F.softmax(mask_cls, dim=-1).max(-1)
         # mask_pred = mask_pred.sigmoid()
             
@@ -619,13 +728,15 @@ class MaskFormer(nn.Module):
         # manu_cls = mask_cls.sigmoid()
         # manu_cls[..., -10:] *= 1.5
         # scores, labels = manu_cls.max(-1)
-        scores, labels = mask_cls.sigmoid().max(-1)
-        mask_pred = mask_pred.sigmoid()
+        if mask_cls_prob is None:
+            mask_cls_prob = mask_cls.sigmoid()
+        scores, labels = mask_cls_prob.max(-1)
+        mask_pred = mask_pred.sigmoid() if mask_pred_prob is None else mask_pred_prob
         keep = labels.ne(self.sem_seg_head.num_classes) & (scores > self.object_mask_threshold)
 
         # OPEN FOR PANOPTIC SEGMENTATION
         T = 0.06 
-        scores, labels = F.softmax(mask_cls.sigmoid() / T, dim=-1).max(-1)
+        scores, labels = F.softmax(mask_cls_prob / T, dim=-1).max(-1)
 
         cur_scores = scores[keep]
         cur_classes = labels[keep]
@@ -633,8 +744,6 @@ class MaskFormer(nn.Module):
         cur_mask_cls = mask_cls[keep]
         cur_mask_cls = cur_mask_cls[:, :-1]
 
-        cur_prob_masks = cur_scores.view(-1, 1, 1) * cur_masks
-
         h, w = cur_masks.shape[-2:]
         panoptic_seg = torch.zeros((h, w), dtype=torch.int32, device=cur_masks.device)
         segments_info = []
@@ -646,16 +755,24 @@ class MaskFormer(nn.Module):
             return panoptic_seg, segments_info
         else:
             # take argmax
-            cur_mask_ids = cur_prob_masks.argmax(0)
+            cur_mask_ids = self.weighted_mask_argmax(cur_scores, cur_masks)
             stuff_memory_list = {}
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                isthing = pred_class in self.metadata.thing_dataset_id_to_contiguous_id.values()
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= 0.5).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
-
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
+            num_masks = cur_classes.shape[0]
+            # pixels whose argmax query also covers them, i.e. the union of the per-query `mask`s
+            owned = cur_masks.gather(0, cur_mask_ids[None])[0] >= 0.5
+            # pull all per-query statistics to the host with one sync instead of four .item() per query
+            stats = torch.stack([
+                cur_classes,
+                torch.bincount(cur_mask_ids.flatten(), minlength=num_masks),
+                (cur_masks >= 0.5).sum(dim=(1, 2)),
+                torch.bincount(cur_mask_ids[owned], minlength=num_masks),
+            ], dim=1).tolist()
+            # segment id each query paints over its owned pixels, 0 leaves them unlabeled
+            query_segment_ids = [0] * num_masks
+            for k, (pred_class, mask_area, original_area, owned_area) in enumerate(stats):
+                isthing = pred_class in self.thing_ids
+
+                if mask_area > 0 and original_area > 0 and owned_area > 0:
                     if mask_area / original_area < self.overlap_threshold:
                         continue
 
@@ -663,13 +780,13 @@ class MaskFormer(nn.Module):
                     
                     if not isthing:
                         if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
+                            query_segment_ids[k] = stuff_memory_list[int(pred_class)]
                             continue
                         else:
                             stuff_memory_list[int(pred_class)] = current_segment_id + 1
 
                     current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
+                    query_segment_ids[k] = current_segment_id
 
                     segments_info.append(
                         {
@@ -679,43 +796,52 @@ class MaskFormer(nn.Module):
                         }
                     )
 
+            # the owned regions of different queries are disjoint, paint all of them in one pass
+            query_segment_ids = torch.as_tensor(query_segment_ids, dtype=torch.int32, device=cur_masks.device)
+            panoptic_seg = query_segment_ids[cur_mask_ids].masked_fill_(~owned, 0)
+
             return panoptic_seg, segments_info
 
-    def instance_inference(self, mask_cls, mask_pred):
+    def instance_inference(self, mask_cls, mask_pred, mask_cls_prob=None, mask_pred_prob=None):
         # mask_pred is already processed to have the same shape as original input
         image_size = mask_pred.shape[-2:]
 
         # [Q, K]
         # scores = F.softmax(mask_cls, dim=-1)[:, :-1]
-        scores = mask_cls.sigmoid()
-        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(self.num_queries, 1).flatten(0, 1)
+        scores = mask_cls.sigmoid() if mask_cls_prob is None else mask_cls_prob
         # scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.num_queries, sorted=False)
         scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.test_topk_per_image, sorted=False)
-        labels_per_image = labels[topk_indices]
+        # the flattened index is query * num_classes + class, no need for a [Q * K] label table
+        labels_per_image = topk_indices % self.sem_seg_head.num_classes
 
         topk_indices = topk_indices // self.sem_seg_head.num_classes
-        # mask_pred = mask_pred.unsqueeze(1).repeat(1, self.sem_seg_head.num_classes, 1).flatten(0, 1)
-        mask_pred = mask_pred[topk_indices]
 
         # if this is panoptic segmentation, we only keep the "thing" classes
         if self.panoptic_on:
-            keep = torch.zeros_like(scores_per_image).bool()
-            for i, lab in enumerate(labels_per_image):
-                keep[i] = lab in self.metadata.thing_dataset_id_to_contiguous_id.values()
+            keep = self.thing_class_mask[labels_per_image]
 
             scores_per_image = scores_per_image[keep]
             labels_per_image = labels_per_image[keep]
-            mask_pred = mask_pred[keep]
+            topk_indices = topk_indices[keep]
+
+        # a query is often picked for several classes, gather and score each distinct mask once
+        query_ids, query_inds = topk_indices.unique(return_inverse=True)
+        # mask_pred = mask_pred.unsqueeze(1).repeat(1, self.sem_seg_head.num_classes, 1).flatten(0, 1)
+        mask_pred = mask_pred[query_ids]
 
         result = Instances(image_size)
-        # mask (before sigmoid)
-        result.pred_masks = (mask_pred > 0).float()
-        result.pred_boxes = Boxes(torch.zeros(mask_pred.size(0), 4))
+        # mask (before sigmoid), stored as uint8, a quarter of the float32 size
+        pred_masks = mask_pred > 0
+        result.pred_masks = pred_masks.to(torch.uint8)[query_inds]
+        result.pred_boxes = Boxes(torch.zeros(query_inds.size(0), 4))
         # Uncomment the following to get boxes from masks (this is slow)
-        # result.pred_boxes = BitMasks(mask_pred > 0).get_bounding_boxes()
+        # result.pred_boxes = BitMasks(result.pred_masks).get_bounding_boxes()
 
-        # calculate average mask prob
-        mask_scores_per_image = (mask_pred.sigmoid().flatten(1) * result.pred_masks.flatten(1)).sum(1) / (result.pred_masks.flatten(1).sum(1) + 1e-6)
+        # calculate average mask prob, in place on the gathered masks and accumulated in fp32
+        mask_probs = mask_pred.sigmoid_() if mask_pred_prob is None else mask_pred_prob[query_ids]
+        mask_probs = mask_probs.masked_fill_(~pred_masks, 0)
+        mask_scores = mask_probs.flatten(1).sum(1, dtype=torch.float32) / (pred_masks.flatten(1).sum(1) + 1e-6)
+        mask_scores_per_image = mask_scores[query_inds]
         result.scores = scores_per_image * mask_scores_per_image
         result.pred_classes = labels_per_image
         return result
@@ -4,7 +4,7 @@
 MaskFormer criterion.
 """
 import logging
-import numpy as np
+from typing import Optional
 
 import torch
 import torch.nn.functional as F
@@ -19,9 +19,15 @@ from detectron2.projects.point_rend.point_features import (
 from ..utils.misc import is_dist_avail_and_initialized, nested_tensor_from_tensor_list
 from mask2former.utils import box_ops
 import time
-import copy
 
-def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: float = 2, mask=None):
+def sigmoid_focal_loss(
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        num_boxes: float,
+        alpha: float = 0.25,
+        gamma: float = 2.0,
+        mask: Optional[torch.Tensor] = None,
+    ):
     """
     Loss used in RetinaNet for dense detection: https://arxiv.org/abs/1708.02002.
     Args:
@@ -37,25 +43,27 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
     Returns:
         Loss tensor
     """
+    # same as binary_cross_entropy_with_logits, written with logsigmoid so the
+    # scripted version fuses into a single elementwise kernel
+    ce_loss = -(targets * F.logsigmoid(inputs) + (1 - targets) * F.logsigmoid(-inputs))
     prob = inputs.sigmoid()
-    # mask = torch.ones_like(inputs)
-    # mask[..., :100] = 0.0
-    # mask += targets
-    # old_mask = (mask==0.0)
-
-    ce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
     p_t = prob * targets + (1 - prob) * (1 - targets)
-    loss = ce_loss * ((1 - p_t) ** gamma)
+    loss = ce_loss * (1 - p_t).pow(gamma)
 
     if alpha >= 0:
         alpha_t = alpha * targets + (1 - alpha) * (1 - targets)
         loss = alpha_t * loss
-    # loss[old_mask] = 0.0
     if mask is not None:
         loss = loss * mask
 
     return loss.mean(1).sum() / num_boxes
 
+
+sigmoid_focal_loss_jit = torch.jit.script(
+    sigmoid_focal_loss
+)  # type: torch.jit.ScriptModule
+
+
 def dice_loss(
         inputs: torch.Tensor,
         targets: torch.Tensor,
@@ -70,11 +78,10 @@ def dice_loss(
                  classification label for each element in inputs
                 (0 for the negative class and 1 for the positive class).
     """
-    inputs = inputs.sigmoid()
-    inputs = inputs.flatten(1)
-    numerator = 2 * (inputs * targets).sum(-1)
-    denominator = inputs.sum(-1) + targets.sum(-1)
-    loss = 1 - (numerator + 1) / (denominator + 1)
+    inputs = inputs.flatten(1).sigmoid()
+    targets = targets.flatten(1)
+    # kept as one expression so the scripted version can fuse the sigmoid with the reductions
+    loss = 1 - (2 * (inputs * targets).sum(-1) + 1) / (inputs.sum(-1) + targets.sum(-1) + 1)
     return loss.sum() / num_masks
 
 
@@ -107,6 +114,32 @@ sigmoid_ce_loss_jit = torch.jit.script(
 )  # type: torch.jit.ScriptModule
 
 
+def kd_kl_loss(
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        temperature: float,
+    ):
+    """
+    KL divergence between the temperature softened class distributions, same as
+    F.kl_div(log_softmax(inputs / T), softmax(targets / T), reduction='batchmean').
+    Args:
+        inputs: logits of the current model, [B, Q, C].
+        targets: logits of the old model, same shape as inputs.
+        temperature: softmax temperature T.
+    Returns:
+        Loss tensor
+    """
+    log_inputs = F.log_softmax(inputs / temperature, dim=-1)
+    log_targets = F.log_softmax(targets / temperature, dim=-1)
+    loss = log_targets.exp() * (log_targets - log_inputs)
+    return loss.sum() / inputs.shape[0]
+
+
+kd_kl_loss_jit = torch.jit.script(
+    kd_kl_loss
+)  # type: torch.jit.ScriptModule
+
+
 def calculate_uncertainty(logits):
     """
     We estimate uncerainty as L1 distance between 0.0 and the logit prediction in 'logits' for the
@@ -120,8 +153,8 @@ def calculate_uncertainty(logits):
             the most uncertain locations having the highest uncertainty score.
     """
     assert logits.shape[1] == 1
-    gt_class_logits = logits.clone()
-    return -(torch.abs(gt_class_logits))
+    # abs() already returns a new tensor, so negate that in place instead of cloning first
+    return logits.abs().neg_()
 
 
 class SetCriterion(nn.Module):
@@ -157,7 +190,20 @@ class SetCriterion(nn.Module):
         self.oversample_ratio = oversample_ratio
         self.importance_sample_ratio = importance_sample_ratio
         self.focal_alpha = 0.25
-        self.current_catagory_ids = torch.tensor(current_catagory_ids)
+        # classes excluded from loss_bboxes_panoptic
+        # For ADE200k
+        # stuff_idx = [0, 1, 2, 3, 4, 5, 6, 9, 11, 13, 16, 17, 21, 25, 26, 28, 29, 34, 40, 46, 48, 51, 52, \
+        #     54, 59, 60, 61, 63, 68, 77, 79, 84, 91, 94, 96, 99, 100, 101, 105, 106, 109, 113, 114, 117, 122, 128, 131, 140, 141, 145]
+        stuff_idx = []
+        self.register_buffer("stuff_idx", torch.tensor(stuff_idx, dtype=torch.long), False)
+        if current_catagory_ids is not None:
+            # moved with the model, so memory_part is computed on the label device
+            self.register_buffer("current_catagory_ids", torch.tensor(current_catagory_ids), False)
+            # first new class id, i.e. number of old classes; a python int so slicing never syncs
+            self.old_class_num = int(min(current_catagory_ids))
+        else:
+            self.current_catagory_ids = None
+            self.old_class_num = 0
         self.vq_number = vq_number
         self.kl_all = kl_all
         self.kd_type = kd_type
@@ -184,71 +230,32 @@ class SetCriterion(nn.Module):
         losses = {"loss_ce": loss_ce}
         return losses
     
-    def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
+    def loss_labels(self, outputs, targets, indices, num_boxes, log=True, perm_idx=None):
         """Classification loss (Binary focal loss)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']
-        assert 'pred_masks' in outputs
-        src_masks = outputs["pred_masks"]
-        # 拿到每个batch的gt mask
-        masks = [t["masks"] for t in targets]
-
-        src_masks = F.interpolate(
-            src_masks,
-            size=(masks[0].shape[-2], masks[0].shape[-1]),
-            mode="bilinear",
-            align_corners=False,
-        )
-        # TODO use valid to mask invalid areas due to padding in loss
-        mask_thresh_hold = 0.0
-        target_masks, valid = nested_tensor_from_tensor_list(masks).decompose()
-        target_masks = target_masks.to(src_logits)
-        target_masks = target_masks.sum(1) != 0
-        b, q, w, h = src_masks.shape
-        omit_query = torch.ones((b, q), dtype=torch.bool, device=src_logits.device)
-        for i, (src_mask, src_target) in enumerate(zip(src_masks, target_masks)):
-            for j, mask in enumerate(src_mask):
-                assert mask.shape == src_target.shape, f"{mask.shape}{src_target.shape}"
-
-                # print(f"{((mask >= mask_thresh_hold) & src_target).sum().item()} VS {(mask >= mask_thresh_hold).sum().item()}")
-                # time.sleep(0.1)
-                
-                if ((mask >= mask_thresh_hold) & src_target).sum().item() <= (mask >= mask_thresh_hold).sum().item() * 0.0:
-                    omit_query[i][j]=0
-        # print(f"omit_query: {(omit_query==0).sum()}")
-        query_mask = omit_query.unsqueeze(-1).repeat(1, 1, src_logits.shape[-1])
-
-        """We don't use query mask"""
-        query_mask = None
-        
-        idx = self._get_src_permutation_idx(indices)
+        idx = self._get_src_permutation_idx(indices) if perm_idx is None else perm_idx[0]
         target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
         target_classes = torch.full(src_logits.shape[:2], self.num_classes,
                                     dtype=torch.int64, device=src_logits.device)
         target_classes[idx] = target_classes_o
 
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], src_logits.shape[2]+1],
-                                            dtype=src_logits.dtype, layout=src_logits.layout, device=src_logits.device)
-        try: 
-            target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
-        except:
-            raise ValueError(f"out of boundry {target_classes_onehot.shape} but got {target_classes}")
-
-        target_classes_onehot = target_classes_onehot[:,:,:-1]
-        loss_ce = sigmoid_focal_loss(src_logits, target_classes_onehot, num_boxes, alpha=self.focal_alpha, gamma=2, mask=query_mask) * src_logits.shape[1]
+        # the extra column is the no-object class, dropped for the focal loss
+        target_classes_onehot = F.one_hot(target_classes, src_logits.shape[2] + 1)[:, :, :-1].to(src_logits.dtype)
+        loss_ce = sigmoid_focal_loss_jit(src_logits, target_classes_onehot, num_boxes, alpha=self.focal_alpha, gamma=2.0) * src_logits.shape[1]
         losses = {'loss_ce': loss_ce}
 
         return losses
 
-    def loss_bboxes_panoptic(self, outputs, targets, indices, num_boxes):
+    def loss_bboxes_panoptic(self, outputs, targets, indices, num_boxes, perm_idx=None):
         """Compute the losses related to the bounding boxes, the L1 regression loss and the GIoU loss
            targets dicts must contain the key "boxes" containing a tensor of dim [nb_target_boxes, 4]
            The target boxes are expected in format (center_x, center_y, w, h), normalized by the image size.
         """
         assert 'pred_boxes' in outputs
-        idx = self._get_src_permutation_idx(indices)
+        idx = self._get_src_permutation_idx(indices) if perm_idx is None else perm_idx[0]
 
         # print("***********debug***********")
         # print(idx)
@@ -261,40 +268,41 @@ class SetCriterion(nn.Module):
 
         src_boxes = outputs['pred_boxes'][idx]
         target_boxes = torch.cat([t['boxes'][i] for t, (_, i) in zip(targets, indices)], dim=0)
-        target_labels = torch.cat([t['labels'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        if 'boxes_xyxy' in targets[0]:
+            target_boxes_xyxy = torch.cat([t['boxes_xyxy'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        else:
+            target_boxes_xyxy = box_ops.box_cxcywh_to_xyxy(target_boxes)
         
         # we only need cxcy
         # target_boxes = target_boxes[:, :2]
         
-        # For ADE200k
-        # stuff_idx = np.array([0, 1, 2, 3, 4, 5, 6, 9, 11, 13, 16, 17, 21, 25, 26, 28, 29, 34, 40, 46, 48, 51, 52, \
-        #     54, 59, 60, 61, 63, 68, 77, 79, 84, 91, 94, 96, 99, 100, 101, 105, 106, 109, 113, 114, 117, 122, 128, 131, 140, 141, 145])
-        stuff_idx = np.array([])
-
-        isthing = ~np.isin(target_labels.cpu().numpy(), stuff_idx)
-        target_boxes=target_boxes[isthing]
-        src_boxes=src_boxes[isthing]
+        # stuff classes get no box loss; nothing to drop while stuff_idx is empty
+        if self.stuff_idx.numel() > 0:
+            target_labels = torch.cat([t['labels'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+            isthing = torch.logical_not(torch.isin(target_labels, self.stuff_idx))
+            target_boxes=target_boxes[isthing]
+            target_boxes_xyxy=target_boxes_xyxy[isthing]
+            src_boxes=src_boxes[isthing]
         # print('modify')
 
         loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none')
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            target_boxes_xyxy)
         losses['loss_giou'] = loss_giou.sum() / num_boxes
 
         return losses
     
-    def loss_masks(self, outputs, targets, indices, num_masks):
+    def loss_masks(self, outputs, targets, indices, num_masks, perm_idx=None):
         """Compute the losses related to the masks: the focal loss and the dice loss.
         targets dicts must contain the key "masks" containing a tensor of dim [nb_target_boxes, h, w]
         """
         assert "pred_masks" in outputs
 
-        src_idx = self._get_src_permutation_idx(indices)
-        tgt_idx = self._get_tgt_permutation_idx(indices)
+        src_idx = self._get_src_permutation_idx(indices) if perm_idx is None else perm_idx[0]
         src_masks = outputs["pred_masks"]
         try: 
             src_masks = src_masks[src_idx]
@@ -302,10 +310,16 @@ class SetCriterion(nn.Module):
         except:
             raise ValueError(f"out of boundry {src_masks.shape} but got {src_idx}")
         masks = [t["masks"] for t in targets]
-        # TODO use valid to mask invalid areas due to padding in loss
-        target_masks, valid = nested_tensor_from_tensor_list(masks).decompose()
-        target_masks = target_masks.to(src_masks)
-        target_masks = target_masks[tgt_idx]
+        if all(m.shape[-2:] == masks[0].shape[-2:] for m in masks):
+            # targets are already padded to the batch size, so gather the matched
+            # masks directly (same order as target_masks[tgt_idx]) instead of padding a copy of all of them
+            target_masks = torch.cat([m[J] for m, (_, J) in zip(masks, indices)]).to(src_masks)
+        else:
+            tgt_idx = self._get_tgt_permutation_idx(indices) if perm_idx is None else perm_idx[1]
+            # TODO use valid to mask invalid areas due to padding in loss
+            target_masks, valid = nested_tensor_from_tensor_list(masks).decompose()
+            target_masks = target_masks.to(src_masks)
+            target_masks = target_masks[tgt_idx]
 
         # No need to upsample predictions as we are using normalized coordinates :)
         # N x 1 x H x W
@@ -348,7 +362,7 @@ class SetCriterion(nn.Module):
         old_logits = targets['pred_logits']
         if targets is not None and self.kd_type == 'kl': # We use kl in this work(SimCIS)
             if not self.kl_all:
-                old_class_num = min(self.current_catagory_ids)
+                old_class_num = self.old_class_num
                 # mask = torch.max(old_logits[...,:old_class_num], dim=-1)[0] > torch.sum(old_logits[...,old_class_num:], dim=-1)
                 # distill_logits = distill_logits[mask]
                 # old_logits = old_logits[mask]
@@ -358,9 +372,6 @@ class SetCriterion(nn.Module):
             # distill_logits = distill_logits[select]
             # old_logits = old_logits[select]           
             T = t
-            distill_probs = F.log_softmax(distill_logits/T, dim=-1)
-            old_probs = F.softmax(old_logits/T, dim=-1)
-            bs = old_probs.shape[0]
 
             # Select with old_probs_entropy 
             # if self.filter_kd:
@@ -382,7 +393,7 @@ class SetCriterion(nn.Module):
             #     print('dis_entropy:',-torch.sum(show_dis * torch.log(show_dis), dim=-1))            
             #     print('old:',torch.topk(show_old, 5, dim=-1))            
             #     print('old_entropy:',-torch.sum(show_old * torch.log(show_old), dim=-1))            
-            kl_loss = F.kl_div(distill_probs, old_probs, reduction='batchmean') #* (T**2)
+            kl_loss = kd_kl_loss_jit(distill_logits, old_logits, float(T)) #* (T**2)
 
 
             # bs = distill_logits.shape[0]
@@ -417,17 +428,29 @@ class SetCriterion(nn.Module):
 
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
-        src_idx = torch.cat([src for (src, _) in indices])
-        return batch_idx, src_idx
+        return self._get_permutation_idx(indices)[0]
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
+        return self._get_permutation_idx(indices)[1]
+
+    def _get_permutation_idx(self, indices):
+        # (batch_idx, src_idx), (batch_idx, tgt_idx) of one matcher output; forward builds it once
+        # per matcher call and passes it to every loss that uses that output
+        src_idx = torch.cat([src for (src, _) in indices])
         tgt_idx = torch.cat([tgt for (_, tgt) in indices])
-        return batch_idx, tgt_idx
+        # src and tgt are matched pairwise, so both share the image index
+        batch_idx = self._get_batch_idx([len(src) for (src, _) in indices], src_idx.device)
+        return (batch_idx, src_idx), (batch_idx.to(tgt_idx.device), tgt_idx)
+
+    @staticmethod
+    def _get_batch_idx(sizes, device):
+        # image index of every matched pair, one repeat_interleave instead of a full_like per image
+        return torch.repeat_interleave(
+            torch.arange(len(sizes), device=device), torch.as_tensor(sizes, device=device)
+        )
 
-    def get_loss(self, loss, outputs, targets, indices, num_masks):
+    def get_loss(self, loss, outputs, targets, indices, num_masks, perm_idx=None):
         loss_map = {
             'labels': self.loss_labels,
             'masks': self.loss_masks,
@@ -435,6 +458,8 @@ class SetCriterion(nn.Module):
             'kd': self.loss_knowledge_distillation,
         }
         assert loss in loss_map, f"do you really want to compute {loss} loss?"
+        if perm_idx is not None:
+            return loss_map[loss](outputs, targets, indices, num_masks, perm_idx=perm_idx)
         return loss_map[loss](outputs, targets, indices, num_masks)
 
     def forward(self, outputs, targets, psd_targets=None, old_targets=None, topk_feats_info=None, old_outputs=None, fake_query_labels=None):
@@ -451,9 +476,13 @@ class SetCriterion(nn.Module):
             # memory_part = [bool(
             #     torch.logical_not(torch.isin(tgt['labels'], self.current_catagory_ids.to(tgt['labels'].device))).sum() != 0
             # ) for tgt in targets]
-            memory_part = [bool(
-                np.logical_not(np.isin(tgt['labels'].cpu().numpy(), self.current_catagory_ids.cpu().numpy())).sum() != 0
-            ) for tgt in targets]
+            # one isin over the whole batch and one host sync, instead of a numpy round trip per image
+            labels = torch.cat([tgt['labels'] for tgt in targets])
+            not_current = torch.logical_not(torch.isin(labels, self.current_catagory_ids))
+            batch_idx = self._get_batch_idx([len(tgt['labels']) for tgt in targets], labels.device)
+            memory_part = torch.zeros(len(targets), dtype=torch.long, device=labels.device).index_add_(
+                0, batch_idx, not_current.long()
+            ).gt(0).tolist()
         else:
             memory_part = None
 
@@ -475,18 +504,29 @@ class SetCriterion(nn.Module):
                         }
                     )
 
-
-        # Retrieve the matching between the outputs of the last layer and the targets
-        outputs_without_aux_no_fakeQuery = self._remove_fake_query(outputs_without_aux)
-        indices = self.matcher(outputs_without_aux_no_fakeQuery, complete_psd_targets)
+        if 'points' in self.losses:
+            # converted once here rather than in loss_bboxes_panoptic for every layer
+            complete_psd_targets = [
+                dict(t, boxes_xyxy=box_ops.box_cxcywh_to_xyxy(t['boxes'])) for t in complete_psd_targets
+            ]
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_masks = sum(len(t["labels"]) for t in complete_psd_targets)
         num_masks = torch.as_tensor(
             [num_masks], dtype=torch.float, device=next(iter(outputs.values())).device
         )
+        # reduce asynchronously so the collective overlaps the matcher below
+        num_masks_handle = None
         if is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_masks)
+            num_masks_handle = torch.distributed.all_reduce(num_masks, async_op=True)
+
+        # Retrieve the matching between the outputs of the last layer and the targets
+        outputs_without_aux_no_fakeQuery = self._remove_fake_query(outputs_without_aux)
+        indices = self.matcher(outputs_without_aux_no_fakeQuery, complete_psd_targets)
+        perm_idx = self._get_permutation_idx(indices)
+
+        if num_masks_handle is not None:
+            num_masks_handle.wait()
         num_masks = torch.clamp(num_masks / get_world_size(), min=1).item()
 
         # Compute all the requested losses
@@ -494,45 +534,50 @@ class SetCriterion(nn.Module):
         for loss in self.losses:
             if loss == 'labels':
                 new_indices, new_targets = self._modify_indices_targets_for_fake_query(indices, complete_psd_targets, fake_query_labels)
-                losses.update(self.get_loss(loss, outputs, new_targets, new_indices, num_masks))
+                losses.update(self.get_loss(loss, outputs, new_targets, new_indices, num_masks,
+                                            perm_idx if new_indices is indices else None))
             elif loss == 'kd':
                 # self.kd_type = 'l2'
                 if not self.kd_deocder:
                     continue
                 losses.update(self.get_loss(loss, outputs['distill_info'], old_outputs, self.kd_temperature2, num_masks))
             else:
-                losses.update(self.get_loss(loss, outputs, complete_psd_targets, indices, num_masks))
+                losses.update(self.get_loss(loss, outputs, complete_psd_targets, indices, num_masks, perm_idx))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if "aux_outputs" in outputs:
             for i, aux_outputs in enumerate(outputs["aux_outputs"]):
                 aux_outputs_no_fakeQuery = self._remove_fake_query(aux_outputs)
                 indices = self.matcher(aux_outputs_no_fakeQuery, complete_psd_targets)
+                perm_idx = self._get_permutation_idx(indices)
                 for loss in self.losses:
                     if loss == 'labels':
                         new_indices, new_targets = self._modify_indices_targets_for_fake_query(indices, complete_psd_targets, fake_query_labels)
-                        l_dict = self.get_loss(loss, aux_outputs, new_targets, new_indices, num_masks)
+                        l_dict = self.get_loss(loss, aux_outputs, new_targets, new_indices, num_masks,
+                                               perm_idx if new_indices is indices else None)
                     elif loss == 'kd':
                         continue
                         l_dict = self.get_loss(loss, outputs['distill_info']['aux_outputs'][i], old_outputs['aux_outputs'][i], indices, num_masks)
                     else:
-                        l_dict = self.get_loss(loss, aux_outputs, complete_psd_targets, indices, num_masks)
+                        l_dict = self.get_loss(loss, aux_outputs, complete_psd_targets, indices, num_masks, perm_idx)
                     l_dict = {k + f"_{i}": v for k, v in l_dict.items()}
                     losses.update(l_dict)
         
         if "interm_outputs" in outputs:
             interm_outputs_no_fakeQuery = self._remove_fake_query(outputs["interm_outputs"])
             indices = self.matcher(interm_outputs_no_fakeQuery, complete_psd_targets)
+            perm_idx = self._get_permutation_idx(indices)
             for loss in self.losses:
                 if loss == 'labels':
                     new_indices, new_targets = self._modify_indices_targets_for_fake_query(indices, complete_psd_targets, fake_query_labels)
-                    l_dict = self.get_loss(loss, outputs["interm_outputs"], new_targets, new_indices, num_masks)
+                    l_dict = self.get_loss(loss, outputs["interm_outputs"], new_targets, new_indices, num_masks,
+                                           perm_idx if new_indices is indices else None)
                 elif loss == 'kd':
                     # self.kd_type = 'kl'
                     # print(self.kd_temperature)
                     l_dict = self.get_loss(loss,outputs['distill_info']['interm_outputs'], old_outputs['interm_outputs'], self.kd_temperature, num_masks)
                 else:
-                    l_dict = self.get_loss(loss, outputs["interm_outputs"], complete_psd_targets, indices, num_masks)
+                    l_dict = self.get_loss(loss, outputs["interm_outputs"], complete_psd_targets, indices, num_masks, perm_idx)
                 l_dict = {'interm_' + k: v for k, v in l_dict.items()}
                 losses.update(l_dict)
         
@@ -542,7 +587,7 @@ class SetCriterion(nn.Module):
         labels = targets.sigmoid()  # B x Q x C
         outputs = inputs.sigmoid()
 
-        old_class_num = min(self.current_catagory_ids)
+        old_class_num = self.old_class_num
         labels = labels[..., :old_class_num]
         outputs = outputs[..., :old_class_num]
         batch_size = outputs.shape[0]
@@ -564,24 +609,18 @@ class SetCriterion(nn.Module):
         assert len(fake_query_labels) == len(targets) == len(indices)
 
         new_indices = []
-        new_targets = copy.deepcopy(targets)
-        for indice in indices:
-            new_indice = list(copy.deepcopy(indice))
-            new_indice[0] = torch.cat((new_indice[0], torch.arange(100,100+self.vq_number).to(torch.long))) # torch.tensor([100, 101, 102], device=indice[0].device)))
-            max_indice = max(indice[1]).long() if len(indice[1]) > 0 else torch.tensor(-1).long()
-            new_indice[1] = torch.cat(
-                (
-                    new_indice[1],
-                    torch.tensor(
-                        [max_indice + i + 1 for i in range(self.vq_number)], 
-                        dtype=torch.long,  
-                        device=indice[0].device 
-                    )
-                )
-            )
-            new_indices.append(new_indice)
-        for i, (t, fql) in enumerate(zip(new_targets, fake_query_labels)):
-            t['labels'] = torch.cat((t['labels'], fql.clone().detach().to(t['labels'].device)))
+        for src, tgt in indices:
+            # fake queries sit after the 100 real ones and are matched to the labels appended below
+            start = int(tgt.max()) + 1 if len(tgt) > 0 else 0
+            new_indices.append((
+                torch.cat((src, torch.arange(100, 100 + self.vq_number, dtype=src.dtype, device=src.device))),
+                torch.cat((tgt, torch.arange(start, start + self.vq_number, dtype=torch.long, device=tgt.device))),
+            ))
+        # only the labels change, so a shallow copy is enough; masks/boxes stay shared
+        new_targets = [
+            dict(t, labels=torch.cat((t['labels'], fql.detach().to(t['labels'].device))))
+            for t, fql in zip(targets, fake_query_labels)
+        ]
         
         return new_indices, new_targets
         
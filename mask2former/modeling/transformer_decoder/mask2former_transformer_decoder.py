@@ -22,7 +22,7 @@ from detectron2.layers import Conv2d
 from .maskformer_transformer_decoder import TRANSFORMER_DECODER_REGISTRY
 from .position_encoding import PositionEmbeddingSine
 from .utils import box_ops
-from .utils.utils import gen_encoder_output_proposals_p, inverse_sigmoid
+from .utils.utils import gen_encoder_output_proposals_p
 
 def generate_random_bbox(n, min_wh=0.1, max_wh=0.5):
     random_wh = torch.rand(n, 2) * (max_wh - min_wh) + min_wh  # (n, 2) -> w 和 h
@@ -34,15 +34,18 @@ def generate_random_bbox(n, min_wh=0.1, max_wh=0.5):
     return random_bbox   
 
 def sigmoid_to_logit(x):
-    x = x.clamp(0.001, 0.999)
-    return torch.log(x / (1-x))
+    # clamps to [0.001, 0.999] and takes log(x / (1 - x)) in one op
+    return torch.logit(x, eps=0.001)
 
 class SelfAttentionLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dropout=0.0,
                  activation="relu", normalize_before=False):
         super().__init__()
+        # called with need_weights=False: the attention weights are never used, and without
+        # them PyTorch >= 2.0 runs the fused scaled_dot_product_attention kernel
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.nhead = nhead
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -60,13 +63,32 @@ class SelfAttentionLayer(nn.Module):
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    def attention(self, qk, value,
+                  attn_mask: Optional[Tensor] = None,
+                  key_padding_mask: Optional[Tensor] = None):
+        if attn_mask is not None or key_padding_mask is not None \
+                or not hasattr(F, "scaled_dot_product_attention"):
+            return self.self_attn(qk, qk, value=value, attn_mask=attn_mask,
+                                  key_padding_mask=key_padding_mask, need_weights=False)[0]
+        # q and k share their input, so project both with one GEMM on the packed
+        # in_proj weight (MultiheadAttention does three when value differs)
+        L, B, E = qk.shape
+        w, b = self.self_attn.in_proj_weight, self.self_attn.in_proj_bias
+        q, k = F.linear(qk, w[:2 * E], b[:2 * E]).chunk(2, dim=-1)
+        v = F.linear(value, w[2 * E:], b[2 * E:])
+        # L x B x E -> B x h x L x E/h
+        q, k, v = [t.reshape(L, B, self.nhead, E // self.nhead).permute(1, 2, 0, 3) for t in (q, k, v)]
+        dropout_p = self.self_attn.dropout if self.training else 0.0
+        tgt2 = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        return self.self_attn.out_proj(tgt2.permute(2, 0, 1, 3).reshape(L, B, E))
+
     def forward_post(self, tgt,
                      tgt_mask: Optional[Tensor] = None,
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
-        q = k = self.with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        q = self.with_pos_embed(tgt, query_pos)
+        tgt2 = self.attention(q, tgt, attn_mask=tgt_mask,
+                              key_padding_mask=tgt_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
 
@@ -77,9 +99,9 @@ class SelfAttentionLayer(nn.Module):
                     tgt_key_padding_mask: Optional[Tensor] = None,
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
-        q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        q = self.with_pos_embed(tgt2, query_pos)
+        tgt2 = self.attention(q, tgt2, attn_mask=tgt_mask,
+                              key_padding_mask=tgt_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
         
         return tgt
@@ -100,7 +122,9 @@ class CrossAttentionLayer(nn.Module):
     def __init__(self, d_model, nhead, dropout=0.0,
                  activation="relu", normalize_before=False):
         super().__init__()
+        # need_weights=False as in SelfAttentionLayer, the attn_mask goes to the fused kernel
         self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.nhead = nhead
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -118,15 +142,44 @@ class CrossAttentionLayer(nn.Module):
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    def attention(self, query, key, value,
+                  attn_mask: Optional[Tensor] = None,
+                  key_padding_mask: Optional[Tensor] = None):
+        if key_padding_mask is not None or (attn_mask is not None and attn_mask.dtype != torch.bool) \
+                or not hasattr(F, "scaled_dot_product_attention"):
+            if attn_mask is not None and attn_mask.dim() == 3 and attn_mask.shape[0] != query.shape[1] * self.nhead:
+                # a B x Q x HW mask shared by all heads, MultiheadAttention wants one per head
+                attn_mask = attn_mask.repeat_interleave(self.nhead, dim=0)
+            return self.multihead_attn(query=query, key=key, value=value, attn_mask=attn_mask,
+                                       key_padding_mask=key_padding_mask, need_weights=False)[0]
+        # MultiheadAttention turns the bool (B*h) x Q x HW mask into an additive float mask of the
+        # same size before the kernel; SDPA takes the bool mask directly (True = may attend)
+        L, B, E = query.shape
+        S = key.shape[0]
+        w_q, w_k, w_v = self.multihead_attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.multihead_attn.in_proj_bias.chunk(3)
+        q = F.linear(query, w_q, b_q).reshape(L, B, self.nhead, E // self.nhead).permute(1, 2, 0, 3)
+        k = F.linear(key, w_k, b_k).reshape(S, B, self.nhead, E // self.nhead).permute(1, 2, 0, 3)
+        v = F.linear(value, w_v, b_v).reshape(S, B, self.nhead, E // self.nhead).permute(1, 2, 0, 3)
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                # (B*h) x Q x HW per head, or B x Q x HW broadcast over the heads
+                attn_mask = attn_mask.reshape(B, -1, L, S)
+            attn_mask = torch.logical_not(attn_mask)
+        dropout_p = self.multihead_attn.dropout if self.training else 0.0
+        tgt2 = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        return self.multihead_attn.out_proj(tgt2.permute(2, 0, 1, 3).reshape(L, B, E))
+
     def forward_post(self, tgt, memory,
                      memory_mask: Optional[Tensor] = None,
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
-                     query_pos: Optional[Tensor] = None):
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+                     query_pos: Optional[Tensor] = None,
+                     key: Optional[Tensor] = None):
+        tgt2 = self.attention(self.with_pos_embed(tgt, query_pos),
+                              self.with_pos_embed(memory, pos) if key is None else key,
+                              memory, attn_mask=memory_mask,
+                              key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
         
@@ -136,12 +189,13 @@ class CrossAttentionLayer(nn.Module):
                     memory_mask: Optional[Tensor] = None,
                     memory_key_padding_mask: Optional[Tensor] = None,
                     pos: Optional[Tensor] = None,
-                    query_pos: Optional[Tensor] = None):
+                    query_pos: Optional[Tensor] = None,
+                    key: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = self.attention(self.with_pos_embed(tgt2, query_pos),
+                              self.with_pos_embed(memory, pos) if key is None else key,
+                              memory, attn_mask=memory_mask,
+                              key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
 
         return tgt
@@ -150,12 +204,14 @@ class CrossAttentionLayer(nn.Module):
                 memory_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                key: Optional[Tensor] = None):
+        # key: memory + pos if the caller already has it, otherwise it is computed here
         if self.normalize_before:
             return self.forward_pre(tgt, memory, memory_mask,
-                                    memory_key_padding_mask, pos, query_pos)
+                                    memory_key_padding_mask, pos, query_pos, key)
         return self.forward_post(tgt, memory, memory_mask,
-                                 memory_key_padding_mask, pos, query_pos)
+                                 memory_key_padding_mask, pos, query_pos, key)
 
 
 class FFNLayer(nn.Module):
@@ -222,9 +278,10 @@ class MLP(nn.Module):
         self.layers = nn.ModuleList(nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim]))
 
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
-        return x
+        # the hidden activations are fresh Linear outputs, so ReLU can overwrite them
+        for layer in self.layers[:-1]:
+            x = F.relu(layer(x), inplace=True)
+        return self.layers[-1](x)
 
 
 @TRANSFORMER_DECODER_REGISTRY.register()
@@ -281,6 +338,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         freeze_label: bool=False,
         add_pos_to_vq: bool=False,
         distribution_alpha: float=0.5,
+        compile_decoder: bool=False,
     ):
         """
         NOTE: this interface is experimental.
@@ -298,6 +356,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             mask_dim: mask feature dimension
             enforce_input_project: add input project 1x1 conv even if input
                 channels and hidden dim is identical
+            compile_decoder: run forward_decoder through torch.compile
         """
         super().__init__()
 
@@ -373,6 +432,8 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                     self.text_embedding.append(torch.from_numpy(text_embedding[old_cls:old_cls+n_cls]))
                 self.text_embedding = torch.cat(self.text_embedding, dim=0).to(torch.device('cuda'))
                 self.text_embedding.requires_grad = False
+                # fixed after construction: keep the D x n_cls operand of the classifier matmul contiguous
+                self.text_embedding_t = self.text_embedding.T.contiguous()
             else:
                 # Use static class head
                 self.class_embed = nn.Linear(hidden_dim, 150)
@@ -394,11 +455,17 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                 #     for i in range(1, len(n_cls_in_tasks)):
                 #         self.class_embeds[i].weight.data.copy_(self.class_embeds[0].weight.data[selectedBysimilarity])
 
-        self.n_cls_in_tasks = torch.as_tensor(n_cls_in_tasks)
+        # plain ints: only used for python-side bookkeeping, never as a tensor
+        self.n_cls_in_tasks = tuple(int(n) for n in n_cls_in_tasks)
         self.mask_embed = MLP(hidden_dim, hidden_dim, mask_dim, 3)
 
         # maskdino like query_pos
         self.ref_point_head = MLP(hidden_dim * 2, hidden_dim, hidden_dim, 2)
+        # frequencies of the sine embedding of the reference points, built once instead of per layer,
+        # as 2 * pi / dim_t so the embedding is a multiply instead of a multiply and a divide
+        dim_t = torch.arange(128, dtype=torch.float32)
+        dim_t = 10000 ** (2 * torch.div(dim_t, 2, rounding_mode='trunc') / 128)
+        self.register_buffer("sine_freq", 2 * math.pi / dim_t, False)
         self.enc_output = nn.Linear(hidden_dim, hidden_dim)
         self.encoder_norm = nn.LayerNorm(hidden_dim)
         # self.ref_point_head = MLP(hidden_dim, hidden_dim, hidden_dim, 2)
@@ -418,7 +485,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             try:
                 with open(os.path.join(output_dir, 'psd_distribution.json'), 'r') as f:
                     psd_dis = json.load(f)
-                    psd_dis = torch.tensor(psd_dis[:int(self.n_cls_in_tasks.sum().item())-int(self.n_cls_in_tasks[-1].item())]) + 1
+                    psd_dis = torch.tensor(psd_dis[:sum(self.n_cls_in_tasks[:-1])]) + 1
                 # self.psd_dis = torch.sqrt(psd_dis.sum()/psd_dis)
                 self.psd_dis = torch.pow(psd_dis.sum() / psd_dis, distribution_alpha)
             except:
@@ -427,6 +494,9 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         else:
             print("No PSD distribution", self.n_cls_in_tasks, self.collect_query_mode[0], type(self.collect_query_mode))
             self.psd_dis = torch.ones(100)
+        # class weights for drawing fake queries. Kept on the CPU on purpose: the drawn classes
+        # index the host-side query library, so sampling on the GPU would only add a sync
+        self.sample_weight = self.psd_dis if self.weighted_sample else torch.ones_like(self.psd_dis)
 
         self.task = len(n_cls_in_tasks)
         if self.task < 10:
@@ -435,6 +505,20 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             query_root = self.output_dir[:-2] + f"{self.task-1}"
 
         self.add_pos_to_vq = add_pos_to_vq
+
+        # the layer loop is many small kernels (LayerNorm, Linear, adds) on ~100 queries, so it is
+        # launch bound; compiled, the pointwise ops are fused. Shapes change with the image size
+        # and the number of fake queries, hence dynamic=True and no CUDA graphs.
+        if compile_decoder and hasattr(torch, "compile"):
+            self.forward_decoder = torch.compile(self.forward_decoder, dynamic=True)
+            # projection, level embedding add and flatten/permute of one scale fuse into one kernel
+            self.prepare_scale = torch.compile(self.prepare_scale, dynamic=True)
+            # the heads also run on the encoder proposals, outside forward_decoder: mask MLP, bmm
+            # and the attention mask thresholding in one graph
+            self.forward_prediction_heads = torch.compile(self.forward_prediction_heads, dynamic=True)
+            # the box head is one module shared by the encoder proposals and every layer; compile its
+            # forward in place (not the module) so the parameter names in the state dict stay the same
+            self._bbox_embed.forward = torch.compile(self._bbox_embed.forward, dynamic=True)
         # if self.task > 1:
         #     # self.query_lib = torch.load(f"{query_root}/fake_query.pkl", map_location='cpu')  # 加载到CPU
         #     with open(f"{query_root}/fake_query.pkl", 'rb') as f:
@@ -487,6 +571,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         ret['freeze_label'] = cfg.CONT.FREEZE_LABEL
         ret['distribution_alpha'] = cfg.CONT.DISTRIBUTION_ALPHA
         ret['add_pos_to_vq'] = cfg.CONT.ADD_POS
+        ret['compile_decoder'] = cfg.MODEL.MASK_FORMER.COMPILE_DECODER
         # print(f"collect_query_mode: {cfg.CONT.COLLECT_QUERY_MODE}")
         return ret
 
@@ -502,12 +587,9 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
 
         for i in range(self.num_feature_levels):
             size_list.append(x[i].shape[-2:])
-            pos.append(self.pe_layer(x[i], None).flatten(2))
-            src.append(self.input_proj[i](x[i]).flatten(2) + self.level_embed.weight[i][None, :, None])
-
-            # flatten NxCxHxW to HWxNxC
-            pos[-1] = pos[-1].permute(2, 0, 1)
-            src[-1] = src[-1].permute(2, 0, 1)
+            pos_i, src_i = self.prepare_scale(x[i], i)
+            pos.append(pos_i)
+            src.append(src_i)
 
         _, bs, _ = src[0].shape
 
@@ -516,19 +598,16 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         # bad_cat = [6, 95, 8, 12, 64, 82, 36, 41, 3, 24, 63, 0, 43, 15, 84, 44, 11, 56, 89, 29, 19, 98, 32, 66, 57, 23, 16, 81, 48, 73, 39, 87, 25, 74, 38, 30, 46, 49, 13, 52, 37, 92, 69, 78, 97, 94, 34, 50, 99, 80]
         # fake_targets = random.sample([0, 1, 2, 3, 4, 5, 7, 8, 9, 10, 12, 14, 15, 16, 17, 18, 19, 20, 22, 23, 24, 27, 28, 30, 31, 32, 36, 38, 39, 40, 41, 42, 43, 47, 53, 57, 66, 67, 69, 82, 85, 89, 93, 98])
         if query_lib is not None and self.vq_number > 0:
-            if not self.weighted_sample:
-                sampleWeight = torch.ones_like(self.psd_dis)
-            else:
-                sampleWeight = self.psd_dis
-            fake_targets = torch.multinomial(sampleWeight, self.vq_number*bs, replacement=True)
-            fake_query = []
-            for i in fake_targets:
-                info = random.sample(query_lib[int(i)], 1)[0]
-                # fake_query.append(torch.as_tensor(info['med_feats'], device=src[0].device, dtype=torch.float32))  # 去掉外面的 []
-                fake_query.append(torch.as_tensor(info, device=src[0].device, dtype=torch.float32))
-
-            # 将列表中的张量拼接
-            fake_query = torch.stack(fake_query, dim=0).reshape(bs, self.vq_number, -1)
+            fake_targets = torch.multinomial(self.sample_weight, self.vq_number*bs, replacement=True)
+            # pick one stored query per sampled class and stack them on the host, so they
+            # reach the GPU in a single copy instead of one per fake query
+            fake_query = torch.stack([
+                torch.as_tensor(random.choice(query_lib[i])) for i in fake_targets.tolist()
+            ])
+            if src[0].is_cuda:
+                # from pinned memory the copy is asynchronous and overlaps with the encoder head below
+                fake_query = fake_query.pin_memory()
+            fake_query = fake_query.to(src[0].device, torch.float32, non_blocking=True).reshape(bs, self.vq_number, -1)
             fake_query = fake_query.detach()
             fake_targets = fake_targets.reshape(bs, -1)
         else:
@@ -543,14 +622,10 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         enc_outputs_coord_unselected = self._bbox_embed(
             output_memory) + reference_point  # (bs, \sum{hw}, 4) unsigmoid
         if self.use_text_embedding:
-            logit_scale = torch.clamp(self.logit_scale.exp(), max=100.0)
-            output_memory_cls = self.dim_adaptor(self.decoder_norm(output_memory))
             # output_memory_cls = self.dim_adaptor(output_memory)
-            output_memory_cls = output_memory_cls / (output_memory_cls.norm(dim=-1, keepdim=True) + 1e-7)
-            enc_outputs_class_unselected = logit_scale * output_memory_cls @ self.text_embedding.T # (bs, \sum{hw}, 100)
+            enc_outputs_class_unselected = self.text_logits(self.decoder_norm(output_memory)) # (bs, \sum{hw}, 100)
             # enc_outputs_class_unselected[reference_point.sum(-1).isinf()] = float("-inf")
         else:
-            # enc_outputs_class_unselected =torch.cat([class_embed(self.decoder_norm(output_memory)) for class_embed in self.class_embeds], dim=-1) # (bs, \sum{hw}, num_classes)
             enc_outputs_class_unselected =self.class_embed(self.decoder_norm(output_memory)) # (bs, \sum{hw}, num_classes)
             # if self.training:
             #     print("new:",enc_outputs_class_unselected[0][0])
@@ -561,18 +636,22 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             #     interm_distill_logits = torch.gather(enc_outputs_class_unselected, 1, distill_position.unsqueeze(-1).repeat(1, 1, enc_outputs_class_unselected.shape[-1]))
             # else:
             #     interm_distill_logits = None
-        topk_proposals = torch.topk(enc_outputs_class_unselected.max(-1)[0], topk, dim=1)[1]
+        # amax: only the per-position best score is ranked, the argmax index of max() is never used
+        topk_proposals = torch.topk(enc_outputs_class_unselected.detach().amax(-1), topk, dim=1)[1]
+        # expand instead of repeat: gather only reads the index, no need to materialize it per channel
         tgt_undetach = torch.gather(output_memory, 1,
-                                  topk_proposals.unsqueeze(-1).repeat(1, 1, hid_dim))
+                                  topk_proposals.unsqueeze(-1).expand(-1, -1, hid_dim))
         distill_tgt_undetach = torch.gather(output_memory, 1,
-                                  distill_position.unsqueeze(-1).repeat(1, 1, hid_dim)) \
+                                  distill_position.unsqueeze(-1).expand(-1, -1, hid_dim)) \
                                       if distill_position is not None else None
         # concat with fake query
         if self.training and self.task >1 and query_lib and self.vq_number > 0:
             tgt_undetach = torch.cat([tgt_undetach, fake_query], dim=1)
 
         refpoint_embed_unsig_undetach = torch.gather(enc_outputs_coord_unselected, 1,
-                                                topk_proposals.unsqueeze(-1).repeat(1, 1, 4))  # unsigmoid
+                                                topk_proposals.unsqueeze(-1).expand(-1, -1, 4))  # unsigmoid
+        # one sigmoid for the interm boxes, the (detached) decoder and distillation reference points
+        refpoint_embed_undetach = refpoint_embed_unsig_undetach.sigmoid()
 
 
         # Get the feats
@@ -585,11 +664,10 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         if distill_position is not None:
             interm_distill_logits, _, distill_attn_mask = self.forward_prediction_heads(
                 distill_tgt_undetach.transpose(0,1), mask_features, attn_mask_target_size=size_list[0]) 
-            distill_refpoint_embed = torch.gather(enc_outputs_coord_unselected, 1,
-                                                topk_proposals.unsqueeze(-1).repeat(1, 1, 4)).\
-                                                    sigmoid().transpose(0, 1).detach()  
+            # same topk_proposals gather as refpoint_embed_unsig_undetach, reuse it
+            distill_refpoint_embed = refpoint_embed_undetach.transpose(0, 1).detach()
 
-        refpoint_embed = refpoint_embed_unsig_undetach.sigmoid().transpose(0, 1).detach() # bs, topk, 4
+        refpoint_embed = refpoint_embed_undetach.transpose(0, 1).detach() # bs, topk, 4
         if self.training and self.task >1 and self.vq_number > 0 and query_lib:
             refpoint_embed = F.pad(refpoint_embed, (0, 0, 0, 0, 0, self.vq_number))
             # random_bboxes = generate_random_bbox(self.vq_number).unsqueeze(1).repeat(1, refpoint_embed.shape[1], 1)  # (bs, self.vq_number, 4)
@@ -600,8 +678,8 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         interm_outputs=dict()
         interm_outputs['pred_logits'] = enc_output_class
         interm_outputs['pred_masks'] = enc_outputs_mask
-        interm_outputs['pred_boxes'] = F.pad(refpoint_embed_unsig_undetach.sigmoid(), (0,0,0,self.vq_number,0,0)) \
-            if self.task > 1 and self.vq_number > 0 else refpoint_embed_unsig_undetach.sigmoid()
+        interm_outputs['pred_boxes'] = F.pad(refpoint_embed_undetach, (0,0,0,self.vq_number,0,0)) \
+            if self.task > 1 and self.vq_number > 0 else refpoint_embed_undetach
         results = self.forward_decoder(
                 output=output, 
                 mask_features=mask_features, 
@@ -659,57 +737,64 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             
             return out, fake_targets
 
+    def prepare_scale(self, x, i: int):
+        # without a padding mask the sine embedding only depends on H x W, so compute it for
+        # one image and broadcast it over the batch (it is only ever added to the memory)
+        pos = self.pe_layer(x[:1], None).flatten(2)
+        src = self.input_proj[i](x).flatten(2) + self.level_embed.weight[i][None, :, None]
+
+        # flatten NxCxHxW to HWxNxC
+        pos = pos.permute(2, 0, 1).expand(-1, x.shape[0], -1)
+        src = src.permute(2, 0, 1)
+        return pos, src
+
+    def text_logits(self, x):
+        # cosine similarity to the class text embeddings; the scale multiplies the B x Q x n_cls
+        # logits instead of the wider normalized features
+        x = self.dim_adaptor(x)
+        x = F.normalize(x, dim=-1, eps=1e-7)
+        logit_scale = torch.clamp(self.logit_scale.exp(), max=100.0)
+        return logit_scale * (x @ self.text_embedding_t)
+
     def forward_prediction_heads(self, output, mask_features, attn_mask_target_size):
         decoder_output = self.decoder_norm(output)
         decoder_output = decoder_output.transpose(0, 1)
         bs,_, _ = decoder_output.shape
         if self.use_text_embedding:
-            cls_decoder = self.dim_adaptor(decoder_output)
-            norm_decoder = cls_decoder / (cls_decoder.norm(dim=-1, keepdim=True) + 1e-7)
-            logit_scale = torch.clamp(self.logit_scale.exp(), max=100.0)
-            outputs_class = logit_scale*norm_decoder @ self.text_embedding.T
+            outputs_class = self.text_logits(decoder_output)
         else:
-            # outputs_class = torch.cat([class_embed(decoder_output) for class_embed in self.class_embeds], dim=-1) # (bs, \sum{hw}, num_classes)
             outputs_class = self.class_embed(decoder_output)
             # outputs_class = torch.cat((-torch.ones((bs, 100,100), device=outputs_class.device)*100, outputs_class), dim=-1)
         mask_embed = self.mask_embed(decoder_output)
-        outputs_mask = torch.einsum("bqc,bchw->bqhw", mask_embed, mask_features)
+        # bqc,bchw->bqhw as a plain batched matmul over the flattened pixels
+        B, C, H, W = mask_features.shape
+        outputs_mask = torch.bmm(mask_embed, mask_features.reshape(B, C, H * W)).view(B, -1, H, W)
 
         # NOTE: prediction is of higher-resolution
-        # [B, Q, H, W] -> [B, Q, H*W] -> [B, h, Q, H*W] -> [B*h, Q, HW]
-        attn_mask = F.interpolate(outputs_mask, size=attn_mask_target_size, mode="bilinear", align_corners=False)
+        # [B, Q, H, W] -> [B, Q, H*W]; the mask is the same for every head, so it is not repeated
+        # per head here, CrossAttentionLayer broadcasts it
+        # the bool mask carries no gradient, detach before the interpolation so autograd does not
+        # record it only to drop it again
+        attn_mask = F.interpolate(outputs_mask.detach(), size=attn_mask_target_size, mode="bilinear", align_corners=False)
         # must use bool type
         # If a BoolTensor is provided, positions with ``True`` are not allowed to attend while ``False`` values will be unchanged.
-        attn_mask = (attn_mask.sigmoid().flatten(2).unsqueeze(1).repeat(1, self.num_heads, 1, 1).flatten(0, 1) < 0.5).bool()
-        attn_mask = attn_mask.detach()
+        # sigmoid(x) < 0.5 is x < 0, no need to run the sigmoid
+        attn_mask = attn_mask.flatten(2) < 0
 
         return outputs_class, outputs_mask, attn_mask
     def _gen_sineembed_for_position(self, pos_tensor):
         # n_query, bs, _ = pos_tensor.size()
         # sineembed_tensor = torch.zeros(n_query, bs, 256)
-        scale = 2 * math.pi
-        dim_t = torch.arange(128, dtype=torch.float32, device=pos_tensor.device)
-        dim_t = 10000 ** (2 * torch.div(dim_t, 2,rounding_mode='trunc') / 128)
-        x_embed = pos_tensor[:, :, 0] * scale
-        y_embed = pos_tensor[:, :, 1] * scale
-        pos_x = x_embed[:, :, None] / dim_t
-        pos_y = y_embed[:, :, None] / dim_t
-        pos_x = torch.stack((pos_x[:, :, 0::2].sin(), pos_x[:, :, 1::2].cos()), dim=3).flatten(2)
-        pos_y = torch.stack((pos_y[:, :, 0::2].sin(), pos_y[:, :, 1::2].cos()), dim=3).flatten(2)
         if pos_tensor.size(-1) == 2:
-            pos = torch.cat((pos_y, pos_x), dim=2)
+            order = [1, 0]  # y, x
         elif pos_tensor.size(-1) == 4:
-            w_embed = pos_tensor[:, :, 2] * scale
-            pos_w = w_embed[:, :, None] / dim_t
-            pos_w = torch.stack((pos_w[:, :, 0::2].sin(), pos_w[:, :, 1::2].cos()), dim=3).flatten(2)
-
-            h_embed = pos_tensor[:, :, 3] * scale
-            pos_h = h_embed[:, :, None] / dim_t
-            pos_h = torch.stack((pos_h[:, :, 0::2].sin(), pos_h[:, :, 1::2].cos()), dim=3).flatten(2)
-
-            pos = torch.cat((pos_y, pos_x, pos_w, pos_h), dim=2)
+            order = [1, 0, 2, 3]  # y, x, w, h
         else:
             raise ValueError("Unknown pos_tensor shape(-1):{}".format(pos_tensor.size(-1)))
+        # embed all coordinates at once: nq x bs x n x 128 -> nq x bs x (n * 128), which is the
+        # concatenation of the per-coordinate sine embeddings in the order above
+        pos = pos_tensor[:, :, order, None] * self.sine_freq
+        pos = torch.stack((pos[..., 0::2].sin(), pos[..., 1::2].cos()), dim=-1).flatten(2)
         return pos
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_seg_masks, out_boxes=None):
@@ -732,7 +817,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
     
     def check_logits(self, logits):
         score, label = logits.max(-1)
-        outrange_mask = (label >= self.n_cls_in_tasks.sum()) | (label < 0)
+        outrange_mask = (label >= sum(self.n_cls_in_tasks)) | (label < 0)
         outNum = torch.sum(outrange_mask)
         return outNum, outrange_mask
 
@@ -740,16 +825,20 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         predictions_class = []
         predictions_mask = []
         predictions_box = []
-        # save = None
+        # the cross-attention keys memory + pos are the same for every layer on a scale, add them once
+        keys = [src_i + pos_i for src_i, pos_i in zip(src, pos)]
         for i in range(self.num_layers):
-            query_sine_embed = self._gen_sineembed_for_position(refpoint_embed) # nq, bs, 256*2
-
-            raw_query_pos = self.ref_point_head(query_sine_embed)  # nq, bs, 256
+            # without box refinement the reference points stay fixed, embed them only once
+            if i == 0 or self.bbox_embed is not None:
+                query_sine_embed = self._gen_sineembed_for_position(refpoint_embed) # nq, bs, 256*2
+                raw_query_pos = self.ref_point_head(query_sine_embed)  # nq, bs, 256
             pos_scale = self.query_scale(output) if self.query_scale is not None else 1
             query_pos = pos_scale * raw_query_pos
             query_embed = query_pos
             level_index = i % self.num_feature_levels
-            attn_mask[torch.where(attn_mask.sum(-1) == attn_mask.shape[-1])] = False
+            # let fully masked queries attend everywhere; masked_fill_ keeps this on the device,
+            # torch.where would first sync to get the number of such rows
+            attn_mask.masked_fill_(attn_mask.all(-1, keepdim=True), False)
             # attention: cross-attention first
             if self.training and self.task >1 and query_lib:
                 fake_query_embed = output[-self.vq_number:,:] #.unsqueeze(0) # x * bs * dim
@@ -765,7 +854,8 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                     output, src[level_index],
                     memory_mask=attn_mask[:,:-self.vq_number,:],
                     memory_key_padding_mask=None,  # here we do not apply masking on padded region
-                    pos=pos[level_index], query_pos=query_embed[:-self.vq_number]
+                    pos=pos[level_index], query_pos=query_embed[:-self.vq_number],
+                    key=keys[level_index]
                 )
                 
                 output = torch.cat([output, fake_query_embed], dim=0)
@@ -779,7 +869,8 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                     output, src[level_index],
                     memory_mask=attn_mask,
                     memory_key_padding_mask=None,  # here we do not apply masking on padded region
-                    pos=pos[level_index], query_pos=query_embed
+                    pos=pos[level_index], query_pos=query_embed,
+                    key=keys[level_index]
                 )
             # FFN
             output = self.transformer_ffn_layers[i](
@@ -788,7 +879,9 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
 
             outputs_class, outputs_mask, attn_mask = self.forward_prediction_heads(output, mask_features, attn_mask_target_size=size_list[(i + 1) % self.num_feature_levels])
             if self.bbox_embed is not None:
-                reference_before_sigmoid = inverse_sigmoid(refpoint_embed)
+                # torch.logit clamps to [eps, 1 - eps] in one kernel; inverse_sigmoid takes five and
+                # only differs below eps, by less than eps
+                reference_before_sigmoid = torch.logit(refpoint_embed, eps=1e-5)
                 delta_unsig = self.bbox_embed[i](output)
                 outputs_unsig = delta_unsig + reference_before_sigmoid
                 new_reference_points = outputs_unsig.sigmoid()
@@ -798,24 +891,6 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                 predictions_box.append(new_reference_points.transpose(0, 1))
             predictions_class.append(outputs_class)
             predictions_mask.append(outputs_mask)
-            
-            # test
-        #     temp = torch.max(outputs_mask.flatten(2), dim=-1)[0] # [B, 100]
-        #     if i == 0:
-        #         save = temp
-        #     else:
-        #         save = torch.cat((save, temp), dim=0)
-
-        # try:
-        #     matrix = np.load('save.npy')
-        #     save = save.cpu().numpy()
-        #     matrix = np.concatenate((matrix, save[None,...]), axis=0)
-        #     np.save('save.npy', matrix)
-        # except:
-        #     np.save('save.npy', save.cpu().numpy()[None,...])
-            
-            
-        # print(f"save shape: {save.shape}")
 
         return (predictions_class, predictions_mask, predictions_box)
 
@@ -76,7 +76,7 @@ def box_iou_pairwise(boxes1, boxes2):
 
     union = area1 + area2 - inter
 
-    iou = inter / union
+    iou = inter / (union + 1e-6)
     return iou, union
 
 
@@ -84,17 +84,20 @@ def generalized_box_iou_pairwise(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
 
+    Same as torch.diag(generalized_box_iou(boxes1, boxes2)) without building
+    the [N, N] matrix.
+
     Input:
         - boxes1, boxes2: N,4
     Output:
-        - giou: N, 4
+        - giou: N
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
     assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
     assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
     assert boxes1.shape == boxes2.shape
-    iou, union = box_iou_pairwise(boxes1, boxes2) # N, 4
+    iou, union = box_iou_pairwise(boxes1, boxes2) # N
 
     lt = torch.min(boxes1[:, :2], boxes2[:, :2])
     rb = torch.max(boxes1[:, 2:], boxes2[:, 2:])
@@ -102,7 +105,7 @@ def generalized_box_iou_pairwise(boxes1, boxes2):
     wh = (rb - lt).clamp(min=0)  # [N,2]
     area = wh[:, 0] * wh[:, 1]
 
-    return iou - (area - union) / area
+    return iou - (area - union) / (area + 1e-6)
 
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+import torch
+from safetensors.torch import save_file
+
+"""
+Usage:
+  pip install safetensors
+  # convert the weights of a trained step, e.g. the old model of step 2
+  ./convert-d2-model-to-safetensors.py output/ps/100-10/step1/model_final.pth
+  # writes output/ps/100-10/step1/model_final.safetensors next to it, which
+  # the continual Trainer prefers over the .pth for CONT.OLD_WEIGHTS.
+"""
+
+if __name__ == "__main__":
+    input = sys.argv[1]
+    output = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(input)[0] + ".safetensors"
+
+    obj = torch.load(input, map_location="cpu", weights_only=True)["model"]
+    # safetensors refuses tensors that share storage, clone them into their own buffers
+    newmodel = {k: v.detach().clone().contiguous() for k, v in obj.items()}
+    save_file(newmodel, output)
+    print("Saved {} tensors to {}".format(len(newmodel), output))